@@ -1,10 +1,13 @@
 # import libraries definition
 from datetime import datetime
 import sys
+import threading
+import time
 from awsglue.transforms import ResolveChoice, Relationalize, DropNullFields
 from awsglue.utils import getResolvedOptions
 from awsglue.dynamicframe import DynamicFrame
 from pyspark.context import SparkContext
+from pyspark.sql import functions as F
 from awsglue.context import GlueContext
 from awsglue.job import Job
 
@@ -37,6 +40,14 @@ num_output_files = int(args['num_output_files'])
 keep_table_prefix = args['keep_table_prefix']
 target_repository = args['target_repo']
 
+# optional parameter collect_metrics: when 'true' the row counts of the written tables are observed by spark
+# while the tables are written (needs Glue 4.0 / Spark 3.3 or later), when off (default) the job triggers no action
+# besides the writes. Counts that haven't arrived metrics_wait_seconds after the last write are printed as unknown
+collect_metrics = False
+if '--collect_metrics' in sys.argv:
+    collect_metrics = getResolvedOptions(sys.argv, ['collect_metrics'])['collect_metrics'].lower() == 'true'
+metrics_wait_seconds = 30
+
 # additional variable inizialization:
 
 dynamicframes_map = {}
@@ -44,6 +55,7 @@ dataframes_map = {}
 s3_target_path_map = {}
 datasink_map = {}
 tables_info_map = {}
+rows_written_map = {}
 
 # variables needed to automatically denormalize the tables
 
@@ -108,6 +120,12 @@ def clean_name(name_type, tbl_name, col_name, table_name_list, text_to_replace):
             new_name = new_name.replace(tbl_name+"_", "")
     return new_name
 
+# Quote a column name with backticks so dots in relationalized names are not read as struct fields
+
+
+def quote_column(col_name):
+    return '`'+col_name.replace('`', '``')+'`'
+
 # Check if a column is a foreign key (it has a suffix _fk)
 
 
@@ -148,6 +166,8 @@ def find_tbl_nested_level(dict, tbl):
 
 def write_to_targets(tbl_name, dyn_frame, target_path, num_output_files, target_repository):
     dyn_frame = dyn_frame.coalesce(num_output_files)
+    if collect_metrics and target_repository != 'none':
+        dyn_frame = count_rows_on_write(tbl_name, dyn_frame)
     if target_repository == 's3' or target_repository == 'all':
         datasink_map[tbl_name] = glueContext.write_dynamic_frame.from_options(frame=dyn_frame, connection_type="s3",
                                                                               connection_options={
@@ -169,6 +189,19 @@ def write_to_targets(tbl_name, dyn_frame, target_path, num_output_files, target_
         dfs = dyn_frame.printSchema()
         print(dfs)
 
+# attaches a row count to the dynamic frame's plan with DataFrame.observe, so spark counts the rows inside the jvm
+# while the write runs instead of running a separate count(). The observation keeps the metrics of the first write,
+# so a table written to both s3 and redshift is counted once
+
+
+def count_rows_on_write(tbl_name, dyn_frame):
+    # imported here so the job still runs on Glue versions without Observation when metrics are off
+    from pyspark.sql import Observation
+
+    rows_written_map[tbl_name] = Observation('rows_written_'+tbl_name)
+    df = dyn_frame.toDF().observe(rows_written_map[tbl_name], F.count(F.lit(1)).alias('rows'))
+    return DynamicFrame.fromDF(df, glueContext, "dynamicframes_map[tbl_name]")
+
 # Loop on the list of table's name and on each attributes to standardize all names
 # it also standardize the name of the join keys created by the  Relationalize transform
 # replacing the default name 'id' with the table name and appending the suffix "_sk"
@@ -284,13 +317,16 @@ def clean_columns_name(tbl_name, tables_info_map):
 
     table_count = table_count+1
 
-    for col_name in tables_info_map[tbl_name]['columns']:
+    # Clean all the column names first and rename the dataframe attributes in a single projection,
+    # chaining one withColumnRenamed per column makes the plan of wide tables very deep and slow to analyze
+    new_col_names = [clean_name('column', tbl_name, col_name, tables_info_map.keys(), '')
+                     for col_name in tables_info_map[tbl_name]['columns']]
+    dataframes_map[tbl_name] = dataframes_map[tbl_name].select(
+        [F.col(quote_column(col_name)).alias(new_col_name)
+         for col_name, new_col_name in zip(tables_info_map[tbl_name]['columns'], new_col_names)
+         if new_col_name != 'rownum'])
 
-        # Clean column name and rename the dataframe attribute
-        new_col_name = clean_name(
-            'column', tbl_name, col_name, tables_info_map.keys(), '')
-        dataframes_map[tbl_name] = dataframes_map[tbl_name].withColumnRenamed(
-            col_name, new_col_name).drop('rownum')
+    for new_col_name in new_col_names:
 
         # if the column is a foreign key and we have configured the job to run the denormalization we will add the child table to the list of tables to join
         if is_foreign_key(new_col_name, tbl_name):
@@ -313,8 +349,28 @@ def print_tables_by_level():
     for lvl, info in tables_to_join_map.items():
         print('Nesting level: ', lvl)
         for i in info.keys():
-            c = dataframes_map[i].count()
-            print(i, ' : ', str(c))
+            print(i, ' : ', len(dataframes_map[i].schema.names), ' columns')
+
+
+def print_rows_written():
+    # observation.get blocks until spark reports the metrics, which never happens when a sink writes through the
+    # RDD API or the write failed, so every table is read on a daemon thread against one shared deadline
+    rows_written = {}
+
+    def get_rows(tbl_name, observation):
+        rows_written[tbl_name] = observation.get['rows']
+
+    threads = []
+    for tbl_name, observation in rows_written_map.items():
+        thread = threading.Thread(target=get_rows, args=(tbl_name, observation))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    deadline = time.time() + metrics_wait_seconds
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    for tbl_name in rows_written_map:
+        print(tbl_name, ' rows written: ', str(rows_written.get(tbl_name, 'unknown')))
 
 
 def denormalize_table(tables_to_join_map, start_join_level, number_nested_levels, dataframes_map, denormlized_dataframe_map):
@@ -360,11 +416,9 @@ def denormalize_table(tables_to_join_map, start_join_level, number_nested_levels
 
                 # execute the join matching left and right join column names to avoid column duplication in the output dataframe
                 df_left = df_left.join(df_right, join_col, how='left_outer')
-                df_joined_count = df_left.count()
                 join_count = join_count+1
                 print('join number: ', join_count)
-                print(left_table, ' left join ', right_table,
-                      'row count is: ', df_joined_count)
+                print(left_table, ' left join ', right_table, ' on ', join_col)
 
         # add the denormalized data frame to the map and continue with the loop
         denormlized_dataframe_map[left_table] = df_left
@@ -512,5 +566,10 @@ for tbl in dynamicframes_map:
         write_to_targets(
             tbl, dynamicframes_map[tbl], s3_target_path_map[tbl], num_output_files, target_repository)
 
+# Optional: print the row counts collected while writing the tables
+
+if collect_metrics:
+    print_rows_written()
+
 
 job.commit()
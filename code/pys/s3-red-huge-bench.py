@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Benchmarks the s3-red-huge sync planner against synthetic S3 listings and pub_master
+# summaries. Nothing here talks to S3 or Redshift: the bucket and the pub_master scan are
+# replaced by in-process stand-ins so planner regressions show up before production.
+import imp
+import json
+import logging
+import os
+import resource
+import time
+import click
+from datetime import datetime as dt, timedelta
+from functools import partial
+from multiprocessing import Process, Queue
+
+srh = imp.load_source('s3_red_huge', os.path.join(os.path.dirname(os.path.abspath(__file__)), 's3-red-huge.py'))
+srh.logger.setLevel(logging.WARNING)
+
+BASE_DATE = dt(2017, 1, 1)
+LAST_MODIFIED = '2017-06-01T00:00:00.000Z'
+INSERTED_AT = dt(2017, 5, 20)
+
+
+class SyntheticKey(object):
+    __slots__ = ('name', 'size', 'last_modified', 'etag')
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.last_modified = LAST_MODIFIED
+        self.etag = '"{:032x}"'.format(hash(name) & (2 ** 128 - 1))
+
+
+class SyntheticPrefix(object):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class SyntheticBucket(object):
+    """Answers the two list calls get_csvs_currently_in_s3 makes, building keys lazily"""
+
+    def __init__(self, dates, orgs):
+        self.dates = dates
+        self.orgs = orgs
+
+    def list(self, prefix='', delimiter=''):
+        if delimiter:
+            return (SyntheticPrefix('{}date={}/'.format(srh.S3_PREFIX, date)) for date in self.dates)
+        return (SyntheticKey('{}org_{}'.format(prefix, org), 1024 + org) for org in range(self.orgs))
+
+
+def synthetic_dates(pairs, orgs):
+    return [(BASE_DATE + timedelta(days=n)).strftime('%Y-%m-%d') for n in range(max(1, pairs // orgs))]
+
+
+def synthetic_csvs(dates, orgs):
+    return [(date, 'org_{}'.format(org), 1024 + org, LAST_MODIFIED, 'e{}'.format(org))
+            for date in dates for org in range(orgs)]
+
+
+def synthetic_pub_master(dates, orgs):
+    # every other org is missing from redshift so the planner has work to emit
+    return [(dt.strptime(date, '%Y-%m-%d'), 'org_{}'.format(org), INSERTED_AT)
+            for date in dates for org in range(0, orgs, 2)]
+
+
+# Each stage builds its fixtures and returns the timed part as a callable returning the item
+# count, so the fixtures are already in the baseline when the stage's memory is measured
+
+
+def bench_listing(dates, orgs):
+    bucket = SyntheticBucket(dates, orgs)
+    return lambda: sum(1 for _ in srh.get_csvs_currently_in_s3(bucket_factory=lambda: bucket))
+
+
+def bench_redshift_index(dates, orgs):
+    pub_master = synthetic_pub_master(dates, orgs)
+    srh.get_date_org_list_from_redshift = lambda: pub_master
+
+    def run():
+        srh.get_redshift_staleness_check()
+        return len(pub_master)
+    return run
+
+
+def bench_plan_from_redshift(dates, orgs, process_by_date):
+    csvs = synthetic_csvs(dates, orgs)
+    pub_master = synthetic_pub_master(dates, orgs)
+    srh.get_date_org_list_from_redshift = lambda: pub_master
+
+    def run():
+        is_stale, _ = srh.get_redshift_staleness_check()
+        return len(srh.get_org_and_date_to_copy_from_s3_to_redshift(csvs, is_stale, process_by_date))
+    return run
+
+
+def bench_plan_from_load_state(dates, orgs, process_by_date):
+    csvs = synthetic_csvs(dates, orgs)
+    load_state = srh.LoadState(':memory:')
+    load_state.record(csvs[::2])
+
+    def run():
+        is_stale = partial(srh.is_stale_in_load_state, loaded=load_state.snapshot())
+        return len(srh.get_org_and_date_to_copy_from_s3_to_redshift(csvs, is_stale, process_by_date))
+    return run
+
+
+STAGES = [
+    ('get_csvs_currently_in_s3', bench_listing),
+    ('redshift index build', bench_redshift_index),
+    ('plan dateorg (redshift)', partial(bench_plan_from_redshift, process_by_date=False)),
+    ('plan date (redshift)', partial(bench_plan_from_redshift, process_by_date=True)),
+    ('plan dateorg (load_state)', partial(bench_plan_from_load_state, process_by_date=False)),
+]
+
+
+def run_stage(stage, pairs, orgs, results):
+    # runs in its own process so ru_maxrss is the peak of this stage alone, the baseline is read
+    # after the fixtures are built so peak_mb is what the timed part adds on top of them
+    run = stage(synthetic_dates(pairs, orgs), orgs)
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    count = run()
+    wall = time.time() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put({'wall_s': round(wall, 3), 'items': count, 'peak_mb': round((peak_kb - baseline_kb) / 1024.0, 1)})
+
+
+@click.command()
+@click.option('--pairs', default='10000,100000,1000000', help='Comma separated (date, org) pair counts')
+@click.option('--orgs', type=int, default=1000, help='Orgs per date partition')
+@click.option('--as-json', is_flag=True, help='Emit one JSON line per measurement')
+def bench(pairs, orgs, as_json):
+    for pair_count in [int(p) for p in pairs.split(',')]:
+        for name, stage in STAGES:
+            results = Queue()
+            worker = Process(target=run_stage, args=(stage, pair_count, orgs, results))
+            worker.start()
+            result = results.get()
+            worker.join()
+            result.update({'stage': name, 'pairs': pair_count})
+            if as_json:
+                print(json.dumps(result))
+            else:
+                print('{pairs:>9} pairs | {stage:<28} | {wall_s:>8.3f}s | {peak_mb:>8.1f}MB | {items} items'.format(
+                    **result))
+
+
+if __name__ == '__main__':
+    bench()
@@ -2,21 +2,68 @@
 import sys
 import click
 import atexit
+import json
 import os
 import logging
 import re
-import subprocess
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from itertools import count
+from multiprocessing.pool import ThreadPool
 from boto.s3.connection import S3Connection
+from boto.utils import parse_ts
 
 from tools.bi_db_consts import RedShiftSpectrum
 from tools.bi_db import DataB
 from datetime import datetime as dt
 from retrying import retry
 
-# gobal declaration of redshift vars for db maintenance
-rshift = None
-vacuum_running = False
-analyze_running = False
+S3_BUCKET = '30d-retention-us-west-2'
+S3_PREFIX = 'temp/'
+S3_LISTING_WORKERS = int(os.getenv('S3_LISTING_WORKERS', 16))
+# matches temp/date=<date>/<org_name>, compiled once for the whole listing
+PARTITION_RE = re.compile(r'^.*date=(?P<date>[^/]+)/(?P<org_name>.+)$')
+
+# one boto connection per listing thread, boto connections are not thread safe
+s3_local = threading.local()
+
+COPY_WORKERS = int(os.getenv('COPY_WORKERS', 4))
+VACUUM_DELETE_THRESHOLD = int(os.getenv('VACUUM_DELETE_THRESHOLD', 5000000))
+VACUUM_SORT_THRESHOLD = int(os.getenv('VACUUM_SORT_THRESHOLD', 20000000))
+ANALYZE_THRESHOLD = int(os.getenv('ANALYZE_THRESHOLD', 10000000))
+MAINTENANCE_RETRY_BACKOFF = int(os.getenv('MAINTENANCE_RETRY_BACKOFF', 300))
+MAINTENANCE_RETRY_BACKOFF_MAX = 60 * 60
+REDSHIFT_CONN_MAX_LIFETIME = int(os.getenv('REDSHIFT_CONN_MAX_LIFETIME', 3600))
+LOAD_STATE_DB = os.getenv('LOAD_STATE_DB', 'load_state.sqlite')
+BOOTSTRAP_GRACE_DAYS = int(os.getenv('BOOTSTRAP_GRACE_DAYS', 5))
+RUN_JOURNAL_DB = os.getenv('RUN_JOURNAL_DB', 'run_journal.sqlite')
+RETRY_ROUNDS = int(os.getenv('RETRY_ROUNDS', 3))
+RETRY_BACKOFF = int(os.getenv('RETRY_BACKOFF', 60))
+RETRY_BACKOFF_MAX = 15 * 60
+METRICS_JSONL = os.getenv('METRICS_JSONL')
+METRICS_PROM = os.getenv('METRICS_PROM')
+
+MERGE_STRATEGY = os.getenv('MERGE_STRATEGY', 'delete-insert')
+SWAP_LOAD_TABLE = 'pub_master_swap_load'
+# pub_master's row grain and measures, every column, hashed by the merge strategy to find changed rows
+PUB_MASTER_GRAIN = (
+    'start_date', 'org_id', 'org_name', 'app', 'source', 'os', 'platform', 'country_field',
+    'adn_sub_campaign_name', 'adn_sub_adnetwork_name', 'adn_original_currency', 'adn_campaign_name', 'keyword',
+    'publisher_id', 'publisher_site_name', 'unified_campaign_name', 'organization_currency')
+PUB_MASTER_MEASURES = (
+    'inserted_at', 'org_partner_cost', 'organization_cost', 'uan_cost', 'adn_cost', 'adn_impressions',
+    'custom_clicks', 'custom_installs', 'adn_original_cost', 'adn_clicks', 'adn_installs', 'revenue_1',
+    'revenue_1_original', 'revenue_7', 'revenue_7_original', 'revenue_14', 'revenue_14_original', 'revenue_30',
+    'revenue_30_original')
+
+MANIFEST_PREFIX = 'manifests/s3-red-huge/'
+MANIFEST_BATCH_BYTES = int(os.getenv('MANIFEST_BATCH_MB', 1024)) * 1024 * 1024
+
+# every pooled redshift connection owns its own temp staging table
+staging_ids = count(1)
 
 logger = logging.getLogger("sync_s3_redshift_mgr")
 formatter = logging.Formatter('%(process)d|%(asctime)s|%(name)s|%(levelname)s|%(message)s')
@@ -34,139 +81,615 @@ logger.addHandler(error_handler)
 logger.setLevel(logging.DEBUG)
 
 
-def vacuum_db():
-    global vacuum_running
-    if not vacuum_running:
-        vacuum_running = True
-        logger.info('Running: {}'.format('fn - vacuum_db'))
-        rshift_4_vacuum = DataB(db_choice=RedShiftSpectrum, sql_language=RedShiftSpectrum.LANGUAGE)
-        rshift_4_vacuum.create_conn()
-        rshift_4_vacuum.conn.execute("""END TRANSACTION; VACUUM pub_master""")
-        rshift_4_vacuum.kill_conn()
-        vacuum_running = False
+class RedshiftPool(object):
+    """Keeps up to `size` DataB connections open across units of work so the TLS and
+    auth handshake is paid once per connection instead of once per instruction.
+    Connections are health checked on checkout and recycled after `max_lifetime`
+    seconds. A separate connection is kept for planning and maintenance queries."""
+
+    def __init__(self, size, max_lifetime=REDSHIFT_CONN_MAX_LIFETIME):
+        self.max_lifetime = max_lifetime
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.maintenance_db = None
+        self.maintenance_lock = threading.Lock()
+
+    def connect(self):
+        logger.info('Running: {}'.format('fn - RedshiftPool.connect'))
+        db = DataB(db_choice=RedShiftSpectrum, sql_language=RedShiftSpectrum.LANGUAGE)
+        db.create_conn()
+        db.created_at = time.time()
+        db.staging = 'pub_staging_{}'.format(next(staging_ids))
+        return db
+
+    def discard(self, db):
+        try:
+            db.kill_conn()
+        except Exception, err:
+            logger.debug('Ignoring error while closing connection: {}'.format(err))
+
+    def is_healthy(self, db):
+        if time.time() - db.created_at > self.max_lifetime:
+            return False
+        try:
+            db.conn.execute("""select 1""")
+            return True
+        except Exception:
+            return False
+
+    def checkout(self):
+        with self.lock:
+            db = self.idle.pop() if self.idle else None
+        if db is not None and not self.is_healthy(db):
+            self.discard(db)
+            db = None
+        return db or self.connect()
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        db = None
+        try:
+            db = self.checkout()
+            yield db
+        except Exception:
+            if db is not None:
+                self.discard(db)
+            db = None
+            raise
+        finally:
+            if db is not None:
+                with self.lock:
+                    self.idle.append(db)
+            self.slots.release()
+
+    @contextmanager
+    def maintenance(self):
+        with self.maintenance_lock:
+            if self.maintenance_db is not None and not self.is_healthy(self.maintenance_db):
+                self.discard(self.maintenance_db)
+                self.maintenance_db = None
+            if self.maintenance_db is None:
+                self.maintenance_db = self.connect()
+            yield self.maintenance_db
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for db in idle:
+            self.discard(db)
+        with self.maintenance_lock:
+            if self.maintenance_db is not None:
+                self.discard(self.maintenance_db)
+                self.maintenance_db = None
+
+
+redshift_pool = RedshiftPool(COPY_WORKERS)
+
+
+def vacuum_db(mode):
+    logger.info('Running: {} {}'.format('fn - vacuum_db', mode))
+    with redshift_pool.maintenance() as db:
+        db.conn.execute("""END TRANSACTION; VACUUM {} pub_master""".format(mode))
 
 
 def re_analyze_db():
-    global analyze_running
-    if not analyze_running:
-        analyze_running = True
-        logger.info('Running: {}'.format('fn - re_analyze_db'))
-        re_analyze_db = DataB(db_choice=RedShiftSpectrum, sql_language=RedShiftSpectrum.LANGUAGE)
-        re_analyze_db.create_conn()
-        re_analyze_db.conn.execute("""END TRANSACTION; ANALYZE pub_master""")
-        re_analyze_db.kill_conn()
-        analyze_running = False
-
-
-def create_conn():
-    logger.info('Running: {}'.format('fn - create_conn'))
-    global rshift
-    rshift = DataB(db_choice=RedShiftSpectrum, sql_language=RedShiftSpectrum.LANGUAGE)
-    rshift.create_conn()
-    return rshift
-
-
-def get_csvs_currently_in_s3():
-    logger.info('Running: {}'.format('fn - get_csvs_currently_in_s3'))
-    s3_dir = subprocess.check_output("s3cmd ls --recursive s3://temp/".split(" "))
+    logger.info('Running: {}'.format('fn - re_analyze_db'))
+    with redshift_pool.maintenance() as db:
+        db.conn.execute("""END TRANSACTION; ANALYZE pub_master PREDICATE COLUMNS""")
+
+
+class MaintenanceScheduler(threading.Thread):
+    """Runs targeted maintenance on pub_master in the background while loads continue.
+    Rows deleted and inserted by the merge step are tallied, and VACUUM DELETE ONLY,
+    VACUUM SORT ONLY and ANALYZE PREDICATE COLUMNS each run once their tally crosses
+    its threshold. Only this thread runs maintenance, so at most one statement is in
+    flight at a time. A failed task is retried after a backoff that doubles with each
+    consecutive failure, up to MAINTENANCE_RETRY_BACKOFF_MAX."""
+
+    def __init__(self, delete_threshold, sort_threshold, analyze_threshold, backoff=MAINTENANCE_RETRY_BACKOFF):
+        threading.Thread.__init__(self, name='pub_master-maintenance')
+        self.daemon = True
+        self.cond = threading.Condition()
+        self.stopping = False
+        # rows touched since the last run of each task, keyed by task
+        self.pending = {'delete': 0, 'sort': 0, 'analyze': 0}
+        self.thresholds = {'delete': delete_threshold, 'sort': sort_threshold, 'analyze': analyze_threshold}
+        self.backoff = backoff
+        # consecutive failures and the earliest time a failed task may run again, keyed by task
+        self.failures = {'delete': 0, 'sort': 0, 'analyze': 0}
+        self.next_attempt_at = {'delete': 0, 'sort': 0, 'analyze': 0}
+
+    def record(self, deleted, inserted):
+        with self.cond:
+            self.pending['delete'] += deleted
+            self.pending['sort'] += inserted
+            self.pending['analyze'] += deleted + inserted
+            self.cond.notify()
+
+    def over_threshold(self):
+        return [task for task in ('delete', 'sort', 'analyze') if self.pending[task] >= self.thresholds[task]]
+
+    def due(self):
+        now = time.time()
+        return [task for task in self.over_threshold() if self.next_attempt_at[task] <= now]
+
+    def wait_timeout(self):
+        # None waits for the next record() or stop(), otherwise wake up when the earliest backoff ends
+        backing_off = [self.next_attempt_at[task] for task in self.over_threshold()]
+        if not backing_off:
+            return None
+        return max(0, min(backing_off) - time.time())
+
+    def run_task(self, task):
+        if task == 'delete':
+            vacuum_db('DELETE ONLY')
+        elif task == 'sort':
+            vacuum_db('SORT ONLY')
+        else:
+            re_analyze_db()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.stopping and not self.due():
+                    self.cond.wait(self.wait_timeout())
+                if self.stopping:
+                    return
+                tasks = self.due()
+                rows = dict((task, self.pending[task]) for task in tasks)
+                for task in tasks:
+                    self.pending[task] = 0
+            for task in tasks:
+                try:
+                    self.run_task(task)
+                except Exception, err:
+                    with self.cond:
+                        self.pending[task] += rows[task]
+                        delay = min(self.backoff * 2 ** self.failures[task], MAINTENANCE_RETRY_BACKOFF_MAX)
+                        self.failures[task] += 1
+                        self.next_attempt_at[task] = time.time() + delay
+                    logger.error('Maintenance {} on pub_master failed, retrying in {}s: {}'.format(task, delay, err))
+                else:
+                    with self.cond:
+                        self.failures[task] = 0
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.join()
+
+
+maintenance_scheduler = None
+
+
+def get_s3_bucket():
+    if getattr(s3_local, 'bucket', None) is None:
+        s3_local.bucket = S3Connection().get_bucket(S3_BUCKET, validate=False)
+    return s3_local.bucket
+
+
+def list_date_prefixes(bucket, prefix=S3_PREFIX):
+    # one delimited list call per page of date= prefixes, no objects are returned here
+    for date_prefix in bucket.list(prefix=prefix + 'date=', delimiter='/'):
+        yield date_prefix.name
+
+
+def list_date_partition(date_prefix, bucket_factory=get_s3_bucket):
+    bucket = bucket_factory()
     csvs = []
-    for x in s3_dir.split("\n"):
-        if len(x) == 0:
+    for key in bucket.list(prefix=date_prefix):
+        match = PARTITION_RE.match(key.name)
+        if match is None:
             continue
-        csvs.append(re.match(".*s3://.*date=(?P<date>[^/]+)/(?P<org_name>.*)", x).groups())
+        csvs.append((match.group('date'), match.group('org_name'), key.size, key.last_modified, key.etag.strip('"')))
     return csvs
 
 
+def get_csvs_currently_in_s3(bucket_factory=get_s3_bucket, workers=S3_LISTING_WORKERS):
+    # Streams (date, org_name, size, last_modified, etag) for every csv under S3_PREFIX,
+    # listing the date= partitions concurrently
+    logger.info('Running: {}'.format('fn - get_csvs_currently_in_s3'))
+    pool = ThreadPool(workers)
+    try:
+        date_prefixes = list_date_prefixes(bucket_factory())
+        for csvs in pool.imap_unordered(partial(list_date_partition, bucket_factory=bucket_factory), date_prefixes):
+            for csv in csvs:
+                yield csv
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def close_all_open_db_connections():
     logger.info('Running: {}'.format('fn - close_all_open_db_connections'))
-    if rshift:
-        rshift.kill_all_db()
+    redshift_pool.close()
+    if load_state:
+        load_state.close()
+    sync_metrics.close()
+    if run_journal:
+        run_journal.close()
 
 
 def get_date_org_list_from_redshift():
     logger.info('Running: {}'.format('fn - get_date_org_list_from_redshift'))
-    # Pulls list [date, org] that exist in redshift
-    create_conn()
+    # Pulls list [date, org, latest inserted_at] that exist in redshift
     rshift_select = """
-                    select start_date, org_name, inserted_at
+                    select start_date, org_name, max(inserted_at)
                     from pub_master
-                    group by 1, 2, 3
-                    order by start_date desc
+                    group by 1, 2
                     """
-    result = rshift.conn.execute(rshift_select)
-    return result.fetchall()
+    with redshift_pool.maintenance() as db:
+        return db.conn.execute(rshift_select).fetchall()
+
 
+class LoadState(object):
+    """Local sqlite index of every (date, org) csv loaded into pub_master, with the
+    S3 etag, size and last_modified it was loaded from and when it was loaded.
+    Lets the planner diff the S3 listing locally instead of scanning pub_master, and
+    reload a csv only when its (etag, size) fingerprint changes."""
 
-def get_org_and_date_to_copy_from_s3_to_redshift(csvs_in_s3, org_dict, org_meta_data, process_by_date):
+    def __init__(self, path=LOAD_STATE_DB):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS load_state (
+                start_date TEXT NOT NULL,
+                org_name TEXT NOT NULL,
+                etag TEXT,
+                size INTEGER,
+                last_modified TEXT,
+                loaded_at TEXT NOT NULL,
+                PRIMARY KEY (start_date, org_name)
+            )
+        """)
+        self.db.commit()
+
+    def is_empty(self):
+        with self.lock:
+            return self.db.execute("""SELECT 1 FROM load_state LIMIT 1""").fetchone() is None
+
+    def snapshot(self):
+        # {(date, org_name): (etag, size, last_modified)}
+        with self.lock:
+            rows = self.db.execute("""SELECT start_date, org_name, etag, size, last_modified FROM load_state""")
+            return dict(((row[0], row[1]), row[2:]) for row in rows)
+
+    def record(self, csvs, loaded_at=None):
+        loaded_at = (loaded_at or dt.utcnow()).strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            self.db.executemany("""
+                INSERT OR REPLACE INTO load_state (start_date, org_name, etag, size, last_modified, loaded_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [(date, org_name, etag, size, last_modified, loaded_at)
+                  for date, org_name, size, last_modified, etag in csvs])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+load_state = None
+
+
+class RunJournal(object):
+    """Durable record of every unit of work in a run and the state it reached:
+    planned, copying, copied (swap runs, waiting for the swap), merged or failed.
+    A run that dies part way through can be resumed from its unmerged units."""
+
+    UNFINISHED = ('planned', 'copying', 'copied', 'failed')
+
+    def __init__(self, path=RUN_JOURNAL_DB):
+        self.lock = threading.Lock()
+        self.run_id = None
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                process_by TEXT NOT NULL,
+                merge_strategy TEXT NOT NULL,
+                started_at TEXT NOT NULL,
+                finished_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS run_units (
+                run_id TEXT NOT NULL,
+                unit_key TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (run_id, unit_key)
+            );
+        """)
+        self.db.commit()
+
+    def now(self):
+        return dt.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+    def plan(self, run_id, process_by, merge_strategy, units):
+        self.run_id = run_id
+        with self.lock:
+            self.db.execute("""INSERT INTO runs (run_id, process_by, merge_strategy, started_at) VALUES (?, ?, ?, ?)""",
+                            (run_id, process_by, merge_strategy, self.now()))
+            self.db.executemany("""
+                INSERT INTO run_units (run_id, unit_key, payload, state, updated_at) VALUES (?, ?, ?, 'planned', ?)
+            """, [(run_id, unit_key, json.dumps(payload), self.now()) for unit_key, payload in units])
+            self.db.commit()
+
+    def resume(self):
+        # the most recent run with unmerged units, as (process_by, merge_strategy, units)
+        with self.lock:
+            row = self.db.execute("""
+                SELECT run_id, process_by, merge_strategy FROM runs
+                WHERE run_id IN (SELECT run_id FROM run_units WHERE state IN ({}))
+                ORDER BY run_id DESC LIMIT 1
+            """.format(', '.join('?' * len(self.UNFINISHED))), self.UNFINISHED).fetchone()
+            if row is None:
+                return None
+            self.run_id = row[0]
+            units = [(unit_key, json.loads(payload)) for unit_key, payload in self.db.execute("""
+                SELECT unit_key, payload FROM run_units WHERE run_id = ? AND state != 'merged' ORDER BY unit_key
+            """, (self.run_id,))]
+            return row[1], row[2], units
+
+    def mark(self, unit_key, state, error=None):
+        with self.lock:
+            self.db.execute("""
+                UPDATE run_units SET state = ?, attempts = attempts + ?, last_error = ?, updated_at = ?
+                WHERE run_id = ? AND unit_key = ?
+            """, (state, 1 if state == 'copying' else 0, error and str(error), self.now(), self.run_id, unit_key))
+            self.db.commit()
+
+    def mark_all(self, from_state, to_state):
+        with self.lock:
+            self.db.execute("""UPDATE run_units SET state = ?, updated_at = ? WHERE run_id = ? AND state = ?""",
+                            (to_state, self.now(), self.run_id, from_state))
+            self.db.commit()
+
+    def finish(self):
+        with self.lock:
+            self.db.execute("""
+                UPDATE runs SET finished_at = ? WHERE run_id = ?
+                    AND NOT EXISTS (SELECT 1 FROM run_units WHERE run_id = ? AND state != 'merged')
+            """, (self.now(), self.run_id, self.run_id))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+run_journal = None
+
+
+def is_stale_in_load_state(csv, loaded):
+    # the csv was never loaded, or its (etag, size) fingerprint differs from the one it was loaded
+    # with. A byte-identical re-upload keeps its fingerprint and is not reloaded.
+    date, org_name, size, last_modified, etag = csv
+    previous = loaded.get((date, org_name))
+    return previous is None or previous[0] != etag or previous[1] != size
+
+
+def is_stale_in_redshift(csv, loaded_in_redshift):
+    # Only used to seed an empty load_state, as pub_master has no fingerprints: the (date, org)
+    # is missing from redshift, or S3 was refreshed more than BOOTSTRAP_GRACE_DAYS after it was loaded
+    date, org_name, size, last_modified, etag = csv
+    previous_upload_to_s3 = loaded_in_redshift.get((date, org_name))
+    if previous_upload_to_s3 is None:
+        return True
+    return (parse_ts(last_modified) - previous_upload_to_s3).days > BOOTSTRAP_GRACE_DAYS
+
+
+def get_redshift_staleness_check():
+    # First run against an empty load_state: fall back to scanning pub_master, and collect
+    # every csv that is already current in redshift so load_state can be seeded with it
+    loaded_in_redshift = {}
+    for start_date, org_name, inserted_at in get_date_org_list_from_redshift():
+        loaded_in_redshift[(dt.strftime(start_date, '%Y-%m-%d'), org_name)] = inserted_at
+
+    current_in_redshift = []
+
+    def is_stale(csv):
+        stale = is_stale_in_redshift(csv, loaded_in_redshift)
+        if not stale:
+            current_in_redshift.append(csv)
+        return stale
+
+    return is_stale, current_in_redshift
+
+
+def get_org_and_date_to_copy_from_s3_to_redshift(csvs_in_s3, is_stale, process_by_date):
+    # size, last_modified and etag come from the listing, no per-key requests are made here.
+    # Each instruction carries the listed csvs it loads so they can be recorded in load_state.
     logger.info('Running: {}'.format('fn - get_org_and_date_to_copy_from_s3_to_redshift'))
-    conn = S3Connection()
-    bucket = conn.get_bucket('30d-retention-us-west-2')
     list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift = []
+    csvs_by_date = {}
+    stale_dates = set()
+
+    for csv in csvs_in_s3:
+        date, org_name, size = csv[:3]
+        if process_by_date:
+            csvs_by_date.setdefault(date, []).append(csv)
+        if size and is_stale(csv):
+            if process_by_date:
+                stale_dates.add(date)
+            else:
+                list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift.append({
+                    'org_name': org_name,
+                    'date': date,
+                    'size': size,
+                    'csvs': [csv]
+                })
 
     if process_by_date:
-        logger.debug('Dates that will be updated in bulk: {}'.format(org_dict.keys()))
-        return org_dict.keys()
+        # a date is reloaded in bulk when any of its orgs is stale
+        logger.debug('Dates that will be updated in bulk: {}'.format(sorted(stale_dates)))
+        for date in sorted(stale_dates):
+            list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift.append({
+                'org_name': None,
+                'date': date,
+                'size': sum(csv[2] for csv in csvs_by_date[date]),
+                'csvs': csvs_by_date[date]
+            })
+    return list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift
 
-    for csv in csvs_in_s3:
+
+class MergeLocks(object):
+    """Serializes merges into pub_master whose (start_date, org) keys overlap.
+    An org of None stands for every org on that date."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.in_flight = set()
+
+    def overlaps(self, key):
+        for date, org_name in self.in_flight:
+            if date == key[0] and (org_name is None or key[1] is None or org_name == key[1]):
+                return True
+        return False
+
+    def acquire(self, keys):
+        with self.cond:
+            while any(self.overlaps(key) for key in keys):
+                self.cond.wait()
+            self.in_flight.update(keys)
+
+    def release(self, keys):
+        with self.cond:
+            self.in_flight.difference_update(keys)
+            self.cond.notify_all()
+
+    @contextmanager
+    def hold(self, keys):
+        keys = set(keys)
+        self.acquire(keys)
         try:
-            key_meta = bucket.get_key('temp/date={}/{}'.format(csv[0], csv[1]))
-            most_recent_uploaded_to_s3 = dt.strptime(key_meta.last_modified, '%a, %d %b %Y %H:%M:%S %Z')
-            previous_upload_to_s3 = org_meta_data[csv[1]]['previous_upload_to_s3']
-
-            if csv[1] not in org_dict.get(csv[0], []) or ((csv[0] == org_meta_data[csv[1]]['date']) and (
-                most_recent_uploaded_to_s3 - previous_upload_to_s3).days > 5
-            ) or (csv[0] != org_meta_data[csv[1]]['date']):
-
-                key_meta = bucket.get_key('temp/date={}/{}'.format(csv[0], csv[1]))
-                if key_meta.size:
-                    list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift.append({
-                        'org_name': csv[1],
-                        'date': csv[0]
-                    })
-                    # logger.debug('Updated Needed on {} for {}{}'.format(csv[0],
-                    #    '{} b/c data was not found in Redshift but s3 file found w/ {}kb of data'.format(
-                    #        csv[1], key_meta.size) if bool(csv[1] not in org_dict.get(csv[0], [])) else '',
-                    #    '{} b/c data was refreshed {} days ago'.format(
-                    #        csv[1], (most_recent_uploaded_to_s3 - previous_upload_to_s3).days) if bool((most_recent_uploaded_to_s3 - previous_upload_to_s3).days > 5) else ''))
-        except Exception:
-            # these are the dates that are not in org_dict as keys
-            pass
-    return list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift
+            yield
+        finally:
+            self.release(keys)
 
 
-def maintain_db_health(counter):
-    logger.info('Running: {}'.format('fn - maintain_db_health'))
-    DataB.kill_all_db()
-    logger.debug('Ended all connections, starting vacumm')
-    vacuum_db()
-    logger.debug('Vacuum completed, starting db analyze')
-    re_analyze_db()
-    logger.debug('Finished db analyze command, creating new conn')
-    global rshift
-    rshift = create_conn()
-    logger.debug('Continuing redshift work')
+merge_locks = MergeLocks()
+
+
+class SyncMetrics(object):
+    """Per-stage spans for every unit of work merged into pub_master.
+    Each span (drop, create_temp, copy, lock_wait, delete, insert, diff, commit, swap) records its
+    duration and, where redshift reports one, the rows it touched. Spans are appended
+    to a JSON lines file and rolled up into a Prometheus textfile-collector file that
+    is rewritten after every unit."""
+
+    STAGES = ('drop', 'create_temp', 'copy', 'lock_wait', 'delete', 'insert', 'diff', 'commit', 'swap')
 
+    def __init__(self, jsonl_path=None, prom_path=None):
+        self.lock = threading.Lock()
+        self.jsonl = open(jsonl_path, 'a') if jsonl_path else None
+        self.prom_path = prom_path
+        self.seconds = dict((stage, 0.0) for stage in self.STAGES)
+        self.runs = dict((stage, 0) for stage in self.STAGES)
+        self.rows = dict((stage, 0) for stage in ('copy', 'delete', 'insert', 'diff', 'swap'))
+        self.units = {'merged': 0, 'failed': 0}
 
-def drop_staging():
+    @contextmanager
+    def unit(self, description):
+        spans = []
+        started = time.time()
+        status = 'failed'
+        try:
+            yield partial(self.span, description, spans)
+            status = 'merged'
+        finally:
+            self.emit({'unit': description, 'stage': 'unit', 'status': status,
+                       'seconds': round(time.time() - started, 3)})
+            with self.lock:
+                self.units[status] += 1
+                for span in spans:
+                    self.seconds[span['stage']] += span['seconds']
+                    self.runs[span['stage']] += 1
+                    if span.get('rows') is not None:
+                        self.rows[span['stage']] += span['rows']
+                self.write_prom()
+
+    @contextmanager
+    def span(self, description, spans, stage):
+        span = {'unit': description, 'stage': stage, 'rows': None}
+        started = time.time()
+        try:
+            yield span
+        finally:
+            span['seconds'] = round(time.time() - started, 3)
+            spans.append(span)
+            self.emit(span)
+
+    def emit(self, record):
+        if self.jsonl is None:
+            return
+        record = dict(record, ts=dt.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+        with self.lock:
+            self.jsonl.write(json.dumps(record) + '\n')
+            self.jsonl.flush()
+
+    def write_prom(self):
+        # called with self.lock held, written to a temp file and renamed so the collector
+        # never reads a partial file
+        if not self.prom_path:
+            return
+        lines = [
+            '# HELP s3_red_huge_stage_seconds_total Time spent in each staging-merge stage.',
+            '# TYPE s3_red_huge_stage_seconds_total counter',
+        ]
+        lines += ['s3_red_huge_stage_seconds_total{{stage="{}"}} {}'.format(stage, self.seconds[stage])
+                  for stage in self.STAGES]
+        lines += [
+            '# HELP s3_red_huge_stage_runs_total Number of times each staging-merge stage ran.',
+            '# TYPE s3_red_huge_stage_runs_total counter',
+        ]
+        lines += ['s3_red_huge_stage_runs_total{{stage="{}"}} {}'.format(stage, self.runs[stage])
+                  for stage in self.STAGES]
+        lines += [
+            '# HELP s3_red_huge_rows_total Rows copied into staging, deleted from and inserted into pub_master.',
+            '# TYPE s3_red_huge_rows_total counter',
+        ]
+        lines += ['s3_red_huge_rows_total{{stage="{}"}} {}'.format(stage, rows)
+                  for stage, rows in sorted(self.rows.items())]
+        lines += [
+            '# HELP s3_red_huge_units_total Units of work by outcome.',
+            '# TYPE s3_red_huge_units_total counter',
+        ]
+        lines += ['s3_red_huge_units_total{{status="{}"}} {}'.format(status, units)
+                  for status, units in sorted(self.units.items())]
+        tmp_path = self.prom_path + '.tmp'
+        with open(tmp_path, 'w') as prom:
+            prom.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self.prom_path)
+
+    def close(self):
+        if self.jsonl is not None:
+            self.jsonl.close()
+
+
+sync_metrics = SyncMetrics()
+
+
+def drop_staging(db, staging):
     logger.info('Running: {}'.format('fn - drop_staging'))
-    rshift.conn.execute("""DROP TABLE IF EXISTS pub_staging;""")
+    db.conn.execute("""DROP TABLE IF EXISTS {};""".format(staging))
 
 
-def create_temp_staging():
+def create_temp_staging(db, staging):
     logger.info('Running: {}'.format('fn - create_temp_staging'))
-    rshift.conn.execute("""
-        CREATE TEMP TABLE pub_staging (LIKE pub_master);
-    """)
+    db.conn.execute("""
+        CREATE TEMP TABLE {} (LIKE pub_master);
+    """.format(staging))
 
 
-def copy_from_s3_to_redshift(date, org_name=None):
-    logger.info('Running: {}'.format('fn - copy_from_s3_to_redshift'))
-    if org_name:
-        s3_url = 's3://temp/date={}/{}'.format(date, org_name)
-    else:
-        s3_url = 's3://temp/date={}'.format(date)
+def copy_into_staging(db, staging, source, options=''):
     copy_command = """
-        COPY pub_staging (start_date, org_id, org_name, inserted_at, org_partner_cost,
+        COPY {} (start_date, org_id, org_name, inserted_at, org_partner_cost,
             organization_cost, uan_cost, app, source, os, platform, country_field, adn_sub_campaign_name,
             adn_sub_adnetwork_name, adn_original_currency, adn_campaign_name, keyword, publisher_id, publisher_site_name,
             unified_campaign_name, organization_currency, adn_cost, adn_impressions, custom_clicks,
@@ -174,31 +697,85 @@ def copy_from_s3_to_redshift(date, org_name=None):
             revenue_7, revenue_7_original, revenue_14, revenue_14_original, revenue_30, revenue_30_original)
         FROM '{}'
         IAM_ROLE '{}'
+        {}
         CSV IGNOREHEADER 1
         TIMEFORMAT AS 'YYYY-MM-DD HH24:MI:SS'
         MAXERROR AS 10;
     """.format(
-        s3_url,
-        os.getenv('ROLE'))
+        staging,
+        source,
+        os.getenv('ROLE'),
+        options)
+
+    db.conn.execute(copy_command)
+
+
+def s3_url_for(date, org_name=None):
+    # the same bucket and prefix get_csvs_currently_in_s3 lists, so COPY loads the objects that were planned
+    if org_name:
+        return 's3://{}/{}date={}/{}'.format(S3_BUCKET, S3_PREFIX, date, org_name)
+    return 's3://{}/{}date={}'.format(S3_BUCKET, S3_PREFIX, date)
+
+
+def copy_from_s3_to_redshift(db, staging, date, org_name=None):
+    logger.info('Running: {}'.format('fn - copy_from_s3_to_redshift'))
+    copy_into_staging(db, staging, s3_url_for(date, org_name))
+
+
+def copy_manifest_to_redshift(db, staging, manifest_url):
+    logger.info('Running: {}'.format('fn - copy_manifest_to_redshift'))
+    copy_into_staging(db, staging, manifest_url, 'MANIFEST')
+
+
+def get_slice_count():
+    logger.info('Running: {}'.format('fn - get_slice_count'))
+    with redshift_pool.maintenance() as db:
+        return db.conn.execute("""select count(*) from stv_slices""").scalar()
 
-    rshift.conn.execute(copy_command)
 
+def batch_instructions(instructions, max_bytes, slices):
+    # Groups dateorg instructions into batches of at least max_bytes, each holding a
+    # multiple of the cluster's slice count so every slice gets a file to load
+    batch, batch_bytes = [], 0
+    for instruction in instructions:
+        batch.append(instruction)
+        batch_bytes += instruction['size']
+        if batch_bytes >= max_bytes and len(batch) % slices == 0:
+            yield batch
+            batch, batch_bytes = [], 0
+    if batch:
+        yield batch
 
-def delete_from_redshift_where_updates_are_present():
+
+def write_manifest(run_id, batch_no, batch):
+    logger.info('Running: {}'.format('fn - write_manifest'))
+    manifest = {
+        'entries': [{
+            'url': s3_url_for(instruction['date'], instruction['org_name']),
+            'mandatory': True,
+            'meta': {'content_length': instruction['size']}
+        } for instruction in batch]
+    }
+    key = get_s3_bucket().new_key('{}{}/{:05d}.manifest'.format(MANIFEST_PREFIX, run_id, batch_no))
+    key.set_contents_from_string(json.dumps(manifest))
+    return 's3://{}/{}'.format(S3_BUCKET, key.name)
+
+
+def delete_from_redshift_where_updates_are_present(db, staging):
     logger.info('Running: {}'.format('fn - delete_from_redshift_where_updates_are_present'))
-    rshift.conn.execute("""BEGIN TRANSACTION;""")
-    rshift.conn.execute("""
+    db.conn.execute("""BEGIN TRANSACTION;""")
+    return db.conn.execute("""
         DELETE FROM pub_master
-            USING pub_staging
-        WHERE pub_master.start_date = pub_staging.start_date
-            AND pub_master.org_id = pub_staging.org_id
-            AND pub_master.org_name = pub_staging.org_name
-    """)
+            USING {0}
+        WHERE pub_master.start_date = {0}.start_date
+            AND pub_master.org_id = {0}.org_id
+            AND pub_master.org_name = {0}.org_name
+    """.format(staging)).rowcount
 
 
-def insert_into_redshift_from_staging():
+def insert_into_redshift_from_staging(db, staging):
     logger.info('Running: {}'.format('fn - insert_into_redshift_from_staging'))
-    rshift.conn.execute("""
+    inserted = db.conn.execute("""
         INSERT INTO pub_master
         SELECT start_date, org_id, org_name, inserted_at, org_partner_cost, organization_cost, uan_cost,
             app, source, os, platform, country_field, adn_sub_campaign_name, adn_sub_adnetwork_name,
@@ -206,84 +783,430 @@ def insert_into_redshift_from_staging():
             unified_campaign_name, organization_currency, adn_cost, adn_impressions, custom_clicks,
             custom_installs, adn_original_cost, adn_clicks, adn_installs, revenue_1, revenue_1_original,
             revenue_7, revenue_7_original, revenue_14, revenue_14_original, revenue_30, revenue_30_original
-        FROM pub_staging;
-    """)
-    rshift.conn.execute("""END TRANSACTION;""")
+        FROM {};
+    """.format(staging)).rowcount
+    db.conn.execute("""END TRANSACTION;""")
+    return inserted
 
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=60000, stop_max_attempt_number=2)
-def do_work(date, org_name=None):
-    logger.info("Copying data from S3 to Redshift for: {}{}".format(
-        org_name if org_name else '', ' - ' + date if org_name else date))
-    trans = rshift.conn.begin()
+def row_hash(table):
+    # null safe fingerprint of a whole row, grain and measures, so unchanged rows can be matched with one equality
+    return "md5({})".format(" || '|' || ".join(
+        "coalesce({}.{}::varchar, '<null>')".format(table, column)
+        for column in PUB_MASTER_GRAIN + PUB_MASTER_MEASURES))
+
+
+def diff_rows_against_staging(db, staging):
+    # one row per full-row hash whose number of copies differs between the csvs and the pub_master rows of
+    # the staged (date, org) pairs. Hashes that match in count are unchanged rows and are left alone.
+    logger.info('Running: {}'.format('fn - diff_rows_against_staging'))
+    db.conn.execute("""
+        DROP TABLE IF EXISTS {0}_diff;
+        CREATE TEMP TABLE {0}_diff AS
+        SELECT coalesce(staged.row_hash, current.row_hash) AS row_hash,
+            coalesce(staged.copies, 0) AS staged_copies,
+            coalesce(current.copies, 0) AS current_copies
+        FROM (SELECT {1} AS row_hash, count(*) AS copies FROM {0} GROUP BY 1) staged
+            FULL JOIN (SELECT {2} AS row_hash, count(*) AS copies
+                       FROM pub_master
+                           JOIN (SELECT DISTINCT start_date, org_id, org_name FROM {0}) pairs
+                           ON pub_master.start_date = pairs.start_date
+                               AND pub_master.org_id = pairs.org_id
+                               AND pub_master.org_name = pairs.org_name
+                       GROUP BY 1) current
+            ON staged.row_hash = current.row_hash
+        WHERE coalesce(staged.copies, 0) <> coalesce(current.copies, 0);
+    """.format(staging, row_hash(staging), row_hash('pub_master')))
+    return db.conn.execute("""SELECT count(*) FROM {}_diff""".format(staging)).scalar()
+
+
+def delete_changed_rows_from_redshift(db, staging):
+    # rows with fewer copies in the csvs, which is every row that changed or vanished, are deleted with
+    # all their copies. The hash covers start_date, org_id and org_name, so only staged pairs can match.
+    logger.info('Running: {}'.format('fn - delete_changed_rows_from_redshift'))
+    return db.conn.execute("""
+        DELETE FROM pub_master
+        WHERE start_date IN (SELECT DISTINCT start_date FROM {0})
+            AND {1} IN (SELECT row_hash FROM {0}_diff WHERE current_copies > staged_copies)
+    """.format(staging, row_hash('pub_master'))).rowcount
+
+
+def insert_changed_rows_from_staging(db, staging):
+    # new rows, plus the copies pub_master is short of: rows deleted above come back in full, rows that only
+    # gained copies get the missing ones
+    logger.info('Running: {}'.format('fn - insert_changed_rows_from_staging'))
+    columns = PUB_MASTER_GRAIN + PUB_MASTER_MEASURES
+    inserted = db.conn.execute("""
+        INSERT INTO pub_master ({1})
+        SELECT {2}
+        FROM (SELECT {0}.*, {3} AS row_hash, row_number() OVER (PARTITION BY {3}) AS copy FROM {0}) numbered
+            JOIN {0}_diff diff ON numbered.row_hash = diff.row_hash
+        WHERE numbered.copy > CASE WHEN diff.current_copies > diff.staged_copies THEN 0
+                                   ELSE diff.current_copies END;
+    """.format(
+        staging,
+        ', '.join(columns),
+        ', '.join('numbered.{}'.format(column) for column in columns),
+        row_hash(staging))).rowcount
+    db.conn.execute("""DROP TABLE {}_diff;""".format(staging))
+    return inserted
+
+
+def merge_delete_insert(db, staging, span):
+    with span('delete') as delete_span:
+        deleted = delete_span['rows'] = delete_from_redshift_where_updates_are_present(db, staging)
+    with span('insert') as insert_span:
+        inserted = insert_span['rows'] = insert_into_redshift_from_staging(db, staging)
+    return deleted, inserted
+
+
+def merge_with_merge(db, staging, span):
+    # only changed rows are deleted and inserted, so an unchanged reload leaves no ghost rows to vacuum
+    with span('diff') as diff_span:
+        diff_span['rows'] = diff_rows_against_staging(db, staging)
+    with span('delete') as delete_span:
+        deleted = delete_span['rows'] = delete_changed_rows_from_redshift(db, staging)
+    with span('insert') as insert_span:
+        inserted = insert_span['rows'] = insert_changed_rows_from_staging(db, staging)
+    return deleted, inserted
+
+
+MERGE_STRATEGIES = {
+    'delete-insert': merge_delete_insert,
+    'merge': merge_with_merge,
+}
+run_merge_strategy = MERGE_STRATEGY
+# csvs copied into SWAP_LOAD_TABLE, recorded in load_state once the swap commits
+swapped_csvs = []
+
+
+def views_bound_to_pub_master():
+    # views that follow pub_master through the rename to pub_master_prev and block dropping it. Late-binding
+    # views (WITH NO SCHEMA BINDING) have no pg_depend entry and survive the swap.
+    with redshift_pool.maintenance() as db:
+        return [name for name, in db.conn.execute("""
+            SELECT DISTINCT vn.nspname || '.' || v.relname
+            FROM pg_depend d
+                JOIN pg_rewrite r ON r.oid = d.objid
+                JOIN pg_class v ON v.oid = r.ev_class
+                JOIN pg_namespace vn ON vn.oid = v.relnamespace
+                JOIN pg_class t ON t.oid = d.refobjid
+                JOIN pg_namespace n ON n.oid = t.relnamespace
+            WHERE t.relname = 'pub_master' AND n.nspname = current_schema() AND v.oid <> t.oid
+        """).fetchall()]
+
+
+def create_swap_load_table():
+    logger.info('Running: {}'.format('fn - create_swap_load_table'))
+    with redshift_pool.maintenance() as db:
+        db.conn.execute("""END TRANSACTION; DROP TABLE IF EXISTS {0}; CREATE TABLE {0} (LIKE pub_master);""".format(
+            SWAP_LOAD_TABLE))
+
+
+# aclitem privilege letters and the GRANT privilege they stand for
+ACL_PRIVILEGES = (('r', 'SELECT'), ('a', 'INSERT'), ('w', 'UPDATE'), ('d', 'DELETE'), ('x', 'REFERENCES'),
+                  ('D', 'DROP'))
+
+
+def grants_for(table, acl, owner):
+    # GRANT statements that give table the privileges listed in another table's relacl,
+    # e.g. 'group dashboards=r/etl' or '=r/etl' for PUBLIC. The owner's own entry is implied.
+    grants = []
+    for item in filter(None, (acl or '').split(',')):
+        grantee, privileges = item.split('/')[0].rsplit('=', 1)
+        if grantee == owner:
+            continue
+        if not grantee:
+            grantee = 'PUBLIC'
+        elif grantee.startswith('group '):
+            grantee = 'GROUP "{}"'.format(grantee[len('group '):])
+        else:
+            grantee = '"{}"'.format(grantee.strip('"'))
+        granted = [name for letter, name in ACL_PRIVILEGES if letter in privileges]
+        if granted:
+            grants.append('GRANT {} ON {} TO {};'.format(', '.join(granted), table, grantee))
+    return grants
+
+
+def swap_dates_into_redshift():
+    # Rebuilds pub_master from its untouched dates plus every date copied this run and renames
+    # the new table into place. Nothing is deleted from the live table, and the exclusive lock
+    # is only held for the renames at the end of the transaction. The rebuild rewrites every row
+    # of pub_master however few dates were reloaded, so the cost of a run grows with the whole
+    # table and swap only pays off when a large share of the dates is reloaded.
+    # pub_master's owner and grants are copied to the new table before it is renamed into place, views bound
+    # to it would keep pub_master_prev alive and are refused before the run starts.
+    logger.info('Running: {}'.format('fn - swap_dates_into_redshift'))
+    with redshift_pool.maintenance() as db, sync_metrics.unit('swap {}'.format(SWAP_LOAD_TABLE)) as span:
+        trans = db.conn.begin()
+        try:
+            with span('swap') as swap_span:
+                owner, acl, current_user = db.conn.execute("""
+                    SELECT pg_get_userbyid(c.relowner), array_to_string(c.relacl, ','), current_user
+                    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                    WHERE c.relname = 'pub_master' AND n.nspname = current_schema()
+                """).fetchone()
+                db.conn.execute("""
+                    DROP TABLE IF EXISTS pub_master_next;
+                    CREATE TABLE pub_master_next (LIKE pub_master);
+                """)
+                for grant in grants_for('pub_master_next', acl, owner):
+                    db.conn.execute(grant)
+                if owner != current_user:
+                    db.conn.execute("""ALTER TABLE pub_master_next OWNER TO "{}";""".format(owner))
+                db.conn.execute("""
+                    INSERT INTO pub_master_next
+                    SELECT * FROM pub_master WHERE start_date NOT IN (SELECT DISTINCT start_date FROM {0});
+                """.format(SWAP_LOAD_TABLE))
+                swap_span['rows'] = db.conn.execute("""
+                    INSERT INTO pub_master_next SELECT * FROM {0};
+                """.format(SWAP_LOAD_TABLE)).rowcount
+                db.conn.execute("""
+                    ALTER TABLE pub_master RENAME TO pub_master_prev;
+                    ALTER TABLE pub_master_next RENAME TO pub_master;
+                    DROP TABLE pub_master_prev;
+                    DROP TABLE {0};
+                """.format(SWAP_LOAD_TABLE))
+            with span('commit'):
+                trans.commit()
+        except Exception:
+            trans.rollback()
+            raise
+    load_state.record(swapped_csvs)
+    run_journal.mark_all('copied', 'merged')
+    # the swapped in table is freshly sorted with no ghost rows, but has no statistics yet
+    re_analyze_db()
+
+
+def merge_unit(description, keys, load_staging, csvs):
+    logger.info("Copying data from S3 to Redshift for: {}".format(description))
+    keys = set(keys)
     try:
-        drop_staging()
-        create_temp_staging()
-        copy_from_s3_to_redshift(date, org_name)
-        delete_from_redshift_where_updates_are_present()
-        insert_into_redshift_from_staging()
-        trans.commit()
-        rshift.kill_all_db()
-        rshift.create_conn()
-        logger.info('Finished: {}{}, Moving on to next instruction'.format(
-            org_name if org_name else '', ' - ' + date if org_name else date))
+        with redshift_pool.connection() as db, sync_metrics.unit(description) as span:
+            staging = db.staging
+            trans = db.conn.begin()
+            try:
+                with span('drop'):
+                    drop_staging(db, staging)
+                with span('create_temp'):
+                    create_temp_staging(db, staging)
+                with span('copy') as copy_span:
+                    load_staging(db, staging)
+                    copy_span['rows'] = db.conn.execute("""select pg_last_copy_count()""").scalar()
+                if run_merge_strategy == 'swap':
+                    # whole dates are appended to the shared load table and swapped in at the end of the run
+                    with span('insert') as insert_span:
+                        insert_span['rows'] = db.conn.execute("""
+                            INSERT INTO {} SELECT * FROM {};
+                        """.format(SWAP_LOAD_TABLE, staging)).rowcount
+                    with span('commit'):
+                        trans.commit()
+                    swapped_csvs.extend(csvs)
+                else:
+                    with span('lock_wait'):
+                        merge_locks.acquire(keys)
+                    try:
+                        deleted, inserted = MERGE_STRATEGIES[run_merge_strategy](db, staging, span)
+                        with span('commit'):
+                            trans.commit()
+                    finally:
+                        merge_locks.release(keys)
+                    maintenance_scheduler.record(deleted, inserted)
+                    load_state.record(csvs)
+            except Exception, err:
+                logger.error("Rolling back: {}".format(err))
+                trans.rollback()
+                raise
+        logger.info('Finished: {}, Moving on to next instruction'.format(description))
     except Exception, err:
-        logger.error("Rolling back: {}".format(err))
-        trans.rollback()
+        # the pool has already discarded the connection this unit failed on,
+        # re-raised so @retry and the run journal see the failure
         logger.error("Writing to errors file: {}".format(err))
-        rshift.kill_all_db()
-        rshift.create_conn()
+        raise
     except KeyboardInterrupt:
         sys.exit()
 
 
-@click.group()
-def cli():
-    pass
+@retry(wait_exponential_multiplier=1000, wait_exponential_max=60000, stop_max_attempt_number=2)
+def do_work(date, org_name=None, csvs=()):
+    merge_unit(
+        '{}{}'.format(org_name if org_name else '', ' - ' + date if org_name else date),
+        [(date, org_name)],
+        partial(copy_from_s3_to_redshift, date=date, org_name=org_name),
+        csvs)
 
 
-@cli.command()
-@click.option('--process-by', type=click.Choice(['date', 'dateorg']), default='date')
-def copy_s3_data_to_redshift(process_by):
-    logger.info('Running: {}'.format('fn - main'))
+@retry(wait_exponential_multiplier=1000, wait_exponential_max=60000, stop_max_attempt_number=2)
+def do_manifest_work(run_id, batch_no, batch):
+    manifest_url = write_manifest(run_id, batch_no, batch)
+    merge_unit(
+        '{} ({} files)'.format(manifest_url, len(batch)),
+        [(instruction['date'], instruction['org_name']) for instruction in batch],
+        partial(copy_manifest_to_redshift, manifest_url=manifest_url),
+        [csv for instruction in batch for csv in instruction['csvs']])
+
+
+def run_journaled(unit_key, work, *args):
+    run_journal.mark(unit_key, 'copying')
+    try:
+        work(*args)
+    except Exception, err:
+        logger.error('Unit {} failed, queued for retry: {}'.format(unit_key, err))
+        run_journal.mark(unit_key, 'failed', err)
+        return False
+    run_journal.mark(unit_key, 'copied' if run_merge_strategy == 'swap' else 'merged')
+    return True
+
+
+def do_instruction(unit):
+    unit_key, instruction = unit
+    return run_journaled(unit_key, do_work, instruction['date'], instruction['org_name'], instruction['csvs'])
+
+
+def do_manifest_instruction(unit):
+    unit_key, manifest_unit = unit
+    return run_journaled(unit_key, do_manifest_work, *manifest_unit)
+
+
+def plan_units(process_by, run_id):
+    # [(unit_key, payload)] for every unit of work in a new run
     process_by_date = True if process_by == 'date' else False
     csvs_in_s3 = get_csvs_currently_in_s3()
 
-    data_from_redshift = get_date_org_list_from_redshift()
-
-    redshift_orgs_organized_by_dict_key_date = {}
-    org_meta_data = {}
-    for date_org_tup in data_from_redshift:
-        org_date = dt.strftime(date_org_tup[0], '%Y-%m-%d')
-        org_name = date_org_tup[1]
-        org_meta_data.update({
-            date_org_tup[1]: {
-                'date': dt.strftime(date_org_tup[0], '%Y-%m-%d'),
-                'previous_upload_to_s3': date_org_tup[2]
-            }
-        })
-
-        if org_date in redshift_orgs_organized_by_dict_key_date.keys():
-            redshift_orgs_organized_by_dict_key_date[org_date].append(org_name)
-        else:
-            redshift_orgs_organized_by_dict_key_date.update({
-                org_date: [org_name]
-            })
+    if load_state.is_empty():
+        is_stale, current_in_redshift = get_redshift_staleness_check()
+    else:
+        is_stale, current_in_redshift = partial(is_stale_in_load_state, loaded=load_state.snapshot()), []
 
     list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift = get_org_and_date_to_copy_from_s3_to_redshift(
-        csvs_in_s3, redshift_orgs_organized_by_dict_key_date, org_meta_data, process_by_date
+        csvs_in_s3, is_stale, process_by_date
     )
+    load_state.record(current_in_redshift)
+
+    if process_by == 'manifest':
+        slices = get_slice_count()
+        units = [
+            ('manifest/{:05d}'.format(batch_no), (run_id, batch_no, batch))
+            for batch_no, batch in enumerate(batch_instructions(
+                list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift, MANIFEST_BATCH_BYTES, slices))
+        ]
+        logger.debug('Coalesced {} instructions into {} manifest batches over {} slices'.format(
+            len(list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift), len(units), slices))
+        return units
+    return [
+        ('{}/{}'.format(instruction['date'], instruction['org_name'] or '*'), instruction)
+        for instruction in list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift
+    ]
+
+
+def map_interruptibly(pool, func, items):
+    # pool.map waits on a lock that Ctrl-C cannot interrupt in python 2, waiting with a timeout can be
+    return pool.map_async(func, items, chunksize=1).get(sys.maxint)
+
 
-    counter = 0
-    for instruction in list_of_org_date_dicts_to_instruct_copy_from_s3_to_redshift:
-        date = instruction if process_by_date else instruction['date']
-        name = None if process_by_date else instruction['org_name']
+def run_units(pool, run_unit, units, retry_rounds, retry_backoff):
+    # runs every unit once, then retries the failed ones with exponential backoff between rounds.
+    # Returns the units that still failed, they stay 'failed' in the journal for --resume.
+    results = map_interruptibly(pool, run_unit, units)
+    failed = [unit for unit, merged in zip(units, results) if not merged]
+    for retry_round in range(retry_rounds):
+        if not failed:
+            break
+        wait = min(retry_backoff * 2 ** retry_round, RETRY_BACKOFF_MAX)
+        logger.info('Retrying {} failed units in {}s'.format(len(failed), wait))
+        time.sleep(wait)
+        results = map_interruptibly(pool, run_unit, failed)
+        failed = [unit for unit, merged in zip(failed, results) if not merged]
+    return failed
 
-        counter += 1
-        if (counter % 30 == 0 or counter == 1):
-            maintain_db_health(counter)
 
-        do_work(date, name)
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--process-by', type=click.Choice(['date', 'dateorg', 'manifest']), default='date')
+@click.option('--workers', type=int, default=COPY_WORKERS, help='Number of concurrent COPY workers')
+@click.option('--vacuum-delete-rows', type=int, default=VACUUM_DELETE_THRESHOLD,
+              help='Deleted rows that trigger VACUUM DELETE ONLY')
+@click.option('--vacuum-sort-rows', type=int, default=VACUUM_SORT_THRESHOLD,
+              help='Inserted rows that trigger VACUUM SORT ONLY')
+@click.option('--analyze-rows', type=int, default=ANALYZE_THRESHOLD,
+              help='Changed rows that trigger ANALYZE PREDICATE COLUMNS')
+@click.option('--state-db', default=LOAD_STATE_DB, help='Local sqlite index of loaded (date, org) csvs')
+@click.option('--metrics-jsonl', default=METRICS_JSONL, help='Append per-stage spans to this JSON lines file')
+@click.option('--metrics-prom', default=METRICS_PROM, help='Write Prometheus textfile-collector metrics here')
+@click.option('--merge-strategy', type=click.Choice(['delete-insert', 'merge', 'swap']), default=MERGE_STRATEGY,
+              help='delete-insert: DELETE USING + INSERT per unit. merge: compare full-row hashes per (date, org) '
+                   'and delete and insert only the rows that changed, unchanged rows are never rewritten. '
+                   'swap: rebuild pub_master with the reloaded dates and rename it into place once at the end of '
+                   'the run. It rewrites the whole table whatever the run reloads, so use it only when a run '
+                   'reloads most of pub_master\'s dates, and views on pub_master must be late-binding '
+                   '(--process-by date only)')
+@click.option('--journal-db', default=RUN_JOURNAL_DB, help='Local sqlite journal of each unit\'s state per run')
+@click.option('--resume', is_flag=True,
+              help='Rerun only the unmerged units of the latest unfinished run, with its --process-by and '
+                   '--merge-strategy, instead of planning a new run')
+@click.option('--retry-rounds', type=int, default=RETRY_ROUNDS, help='Rounds of retries for failed units')
+@click.option('--retry-backoff', type=int, default=RETRY_BACKOFF,
+              help='Seconds before the first retry round, doubled each round')
+def copy_s3_data_to_redshift(process_by, workers, vacuum_delete_rows, vacuum_sort_rows, analyze_rows, state_db,
+                             metrics_jsonl, metrics_prom, merge_strategy, journal_db, resume, retry_rounds,
+                             retry_backoff):
+    logger.info('Running: {}'.format('fn - main'))
+    global redshift_pool, maintenance_scheduler, load_state, sync_metrics, run_merge_strategy, run_journal
+    run_journal = RunJournal(journal_db)
+    if resume:
+        resumed = run_journal.resume()
+        if resumed is None:
+            logger.info('No unfinished run to resume')
+            return
+        process_by, merge_strategy, units = resumed
+        logger.info('Resuming run {} with {} unmerged units'.format(run_journal.run_id, len(units)))
+    if merge_strategy == 'swap' and process_by != 'date':
+        raise click.BadParameter('swap only applies to whole-date loads, use --process-by date',
+                                 param_hint='--merge-strategy')
+    run_merge_strategy = merge_strategy
+    redshift_pool = RedshiftPool(workers)
+    if merge_strategy == 'swap':
+        bound_views = views_bound_to_pub_master()
+        if bound_views:
+            raise click.BadParameter(
+                'swap would end with DROP TABLE pub_master_prev failing on the views bound to it ({}), recreate '
+                'them WITH NO SCHEMA BINDING or use another strategy'.format(', '.join(bound_views)),
+                param_hint='--merge-strategy')
+    maintenance_scheduler = MaintenanceScheduler(vacuum_delete_rows, vacuum_sort_rows, analyze_rows)
+    load_state = LoadState(state_db)
+    sync_metrics = SyncMetrics(metrics_jsonl, metrics_prom)
+    if not resume:
+        run_id = dt.utcnow().strftime('%Y%m%dT%H%M%S')
+        units = plan_units(process_by, run_id)
+        run_journal.plan(run_id, process_by, merge_strategy, units)
+    run_unit = do_manifest_instruction if process_by == 'manifest' else do_instruction
+
+    if merge_strategy == 'swap' and units:
+        create_swap_load_table()
+
+    maintenance_scheduler.start()
+    pool = ThreadPool(workers)
+    try:
+        failed = run_units(pool, run_unit, units, retry_rounds, retry_backoff)
+        if merge_strategy == 'swap' and swapped_csvs:
+            swap_dates_into_redshift()
+        if failed:
+            logger.error('{} units still failed after {} retry rounds, rerun with --resume: {}'.format(
+                len(failed), retry_rounds, ', '.join(unit_key for unit_key, _ in failed)))
+        run_journal.finish()
+    except BaseException:
+        # Ctrl-C or a failed step: drop the queued units instead of running them all before exiting
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        maintenance_scheduler.stop()
 
 
 if __name__ == '__main__':
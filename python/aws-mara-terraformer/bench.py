@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for TerraformGenerator against a moto stand-in for AWS.
+Seeds N instances, security groups, VPCs and buckets, then times export_all or generate_consolidated writing
+into a temp dir, first a clean export and then an unchanged rerun
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+from multiprocessing import Process, Queue
+from pathlib import Path
+
+import boto3
+from moto import mock_aws
+
+from main import BULK_WORKERS, TerraformGenerator
+
+REGION = 'us-east-1'
+
+
+def seed(count):
+    """Create count VPCs, security groups, instances and buckets, returns every resource ID"""
+    ec2 = boto3.client('ec2', region_name=REGION)
+    s3 = boto3.client('s3', region_name=REGION)
+    vpc_ids = [ec2.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId'] for _ in range(count)]
+    sg_ids = [
+        ec2.create_security_group(GroupName=f'bench-{n}', Description='bench', VpcId=vpc_ids[n])['GroupId']
+        for n in range(count)
+    ]
+    instance_ids = []
+    while len(instance_ids) < count:
+        batch = min(1000, count - len(instance_ids))
+        instances = ec2.run_instances(ImageId='ami-12c6146b', MinCount=batch, MaxCount=batch)['Instances']
+        instance_ids.extend(instance['InstanceId'] for instance in instances)
+    bucket_names = [f'bench-bucket-{n}' for n in range(count)]
+    for bucket_name in bucket_names:
+        s3.create_bucket(Bucket=bucket_name)
+    return vpc_ids + sg_ids + instance_ids + bucket_names
+
+
+def run_export(resource_ids, output_path, workers, consolidated):
+    """prefetch -> export -> rerun through the real exporters, returns ({phase: seconds}, modules, {api: calls})"""
+    calls = Counter()
+    phases = {}
+    
+    def generator():
+        # a fresh generator per run, so the rerun describes everything again like a scheduled run would
+        fresh = TerraformGenerator(region=REGION)
+        for client in (fresh.ec2, fresh.s3, fresh.rds, fresh.elb):
+            client.meta.events.register('before-call', lambda event_name, **kwargs: calls.update([event_name]))
+        return fresh
+    
+    for phase in ('export', 'rerun'):
+        exporter = generator()
+        start = time.time()
+        resources = exporter.prefetch(resource_ids)
+        phases[f'{phase}_prefetch'] = time.time() - start
+        
+        start = time.time()
+        export = exporter.generate_consolidated if consolidated else exporter.export_all
+        # the exporters' per-module progress lines would drown the results
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            succeeded = export(resources, output_path, workers=workers)
+        if not succeeded:
+            raise RuntimeError(f'{phase} failed')
+        phases[phase] = time.time() - start
+    
+    module_paths = (output_path / 'modules').iterdir() if consolidated else output_path.iterdir()
+    modules = sum(1 for path in module_paths if path.is_dir())
+    return phases, modules, {event.split('.')[-1]: count for event, count in calls.items()}
+
+
+def run_size(count, workers, consolidated, results):
+    # runs in its own process so ru_maxrss is the peak of this size alone
+    with mock_aws():
+        seed_start = time.time()
+        resource_ids = seed(count)
+        seed_seconds = time.time() - seed_start
+        baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        output_path = Path(tempfile.mkdtemp(prefix='terraformer-bench-'))
+        try:
+            start = time.time()
+            phases, modules, calls = run_export(resource_ids, output_path, workers, consolidated)
+            wall = time.time() - start
+        finally:
+            shutil.rmtree(output_path)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put({
+        'n': count,
+        'resources': len(resource_ids),
+        'modules': modules,
+        'seed_s': round(seed_seconds, 2),
+        'wall_s': round(wall, 3),
+        'phases_s': {phase: round(seconds, 3) for phase, seconds in phases.items()},
+        'api_calls': sum(calls.values()),
+        'calls_by_api': calls,
+        'peak_mb': round((peak_kb - baseline_kb) / 1024.0, 1),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TerraformGenerator bulk exports against moto')
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='Comma separated N, each seeds N of every resource type (default: 100,1000,10000)')
+    parser.add_argument('--workers', type=int, default=BULK_WORKERS, help=f'Export workers (default: {BULK_WORKERS})')
+    parser.add_argument('--consolidated', action='store_true', help='Time generate_consolidated instead of export_all')
+    parser.add_argument('--as-json', action='store_true', help='Emit one JSON line per size')
+    args = parser.parse_args()
+
+    for count in [int(size) for size in args.sizes.split(',')]:
+        results = Queue()
+        worker = Process(target=run_size, args=(count, args.workers, args.consolidated, results))
+        worker.start()
+        result = results.get()
+        worker.join()
+        if args.as_json:
+            print(json.dumps(result))
+            continue
+        phases = ' '.join(f'{phase}={seconds:.3f}s' for phase, seconds in result['phases_s'].items())
+        print(f"{result['n']:>6} N | {result['resources']:>6} resources | {result['wall_s']:>8.3f}s | "
+              f"{result['api_calls']:>6} calls | {result['peak_mb']:>7.1f}MB | {phases}")
+
+
+if __name__ == '__main__':
+    main()
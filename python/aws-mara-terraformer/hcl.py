@@ -0,0 +1,443 @@
+"""
+Precompiled HCL templates and a module writer that streams rendered blocks to file handles
+"""
+
+import hashlib
+import json
+from pathlib import Path
+from string import Formatter
+
+# part of every resource fingerprint, so editing a template re-renders everything it produces
+TEMPLATES_FINGERPRINT = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+
+
+def hcl(value):
+    """HCL literal for a Python value, dicts become a map for a top level attribute"""
+    if value is None:
+        return 'null'
+    if isinstance(value, dict):
+        entries = ''.join(f'    {hcl(key)} = {hcl(item)}\n' for key, item in value.items())
+        return f'{{\n{entries}  }}'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    # JSON strings and lists are valid HCL once template sequences are escaped
+    return json.dumps(value, ensure_ascii=False).replace('${', '$${').replace('%{', '%%{')
+
+
+class HclMap(dict):
+    """A map attribute inside an hcl_block body, where a plain dict would be a nested block"""
+
+
+def hcl_block(handle, name, body, indent='  '):
+    """Write a nested block. Dict values become blocks, lists of dicts repeated blocks, None is left out
+    and anything else an attribute"""
+    handle.write(f'{indent}{name} {{\n')
+    for key, value in body.items():
+        if value is None:
+            continue
+        if isinstance(value, HclMap):
+            entries = ', '.join(f'{hcl(map_key)} = {hcl(item)}' for map_key, item in value.items())
+            handle.write(f'{indent}  {key} = {{ {entries} }}\n')
+        elif isinstance(value, dict):
+            hcl_block(handle, key, value, indent + '  ')
+        elif isinstance(value, list) and all(isinstance(item, dict) for item in value):
+            for item in value:
+                hcl_block(handle, key, item, indent + '  ')
+        else:
+            handle.write(f'{indent}  {key} = {hcl(value)}\n')
+    handle.write(f'{indent}}}\n')
+
+
+class HclTemplate:
+    """A str.format template parsed once into literal chunks and field names, rendered straight into a handle"""
+
+    def __init__(self, source):
+        self.parts = [(literal, field) for literal, field, _, _ in Formatter().parse(source)]
+
+    def render(self, handle, values):
+        for literal, field in self.parts:
+            handle.write(literal)
+            if field is not None:
+                handle.write(values[field])
+
+
+class ModuleWriter:
+    """main.tf, variables.tf and outputs.tf handles for one module directory.
+    The region and environment variables every resource uses are written once per module"""
+
+    def __init__(self, output_path, region):
+        output_path.mkdir(parents=True, exist_ok=True)
+        self.main = open(output_path / 'main.tf', 'w')
+        self.variables = open(output_path / 'variables.tf', 'w')
+        self.outputs = open(output_path / 'outputs.tf', 'w')
+        self.environment = 'production'
+        REGION_VARIABLE.render(self.variables, {'region': hcl(region)})
+
+    def close(self):
+        ENVIRONMENT_VARIABLE.render(self.variables, {'environment': hcl(self.environment)})
+        for handle in (self.main, self.variables, self.outputs):
+            handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+REGION_VARIABLE = HclTemplate('''variable "region" {{
+  description = "AWS region"
+  type        = string
+  default     = {region}
+}}
+''')
+
+ENVIRONMENT_VARIABLE = HclTemplate('''
+variable "environment" {{
+  description = "Environment tag"
+  type        = string
+  default     = {environment}
+}}
+''')
+
+EC2_MAIN = HclTemplate('''# EC2 Instance Configuration
+resource "aws_instance" "{resource_name}" {{
+  ami                         = var.ami_id
+  instance_type              = var.instance_type
+  subnet_id                  = var.subnet_id
+  vpc_security_group_ids     = var.security_group_ids
+  key_name                   = var.key_name
+  associate_public_ip_address = var.associate_public_ip
+
+  root_block_device {{
+    volume_size = var.root_volume_size
+    volume_type = var.root_volume_type
+  }}
+
+  tags = {{
+    Name        = var.instance_name
+    Environment = var.environment
+    ManagedBy   = "Terraform"
+  }}
+}}
+''')
+
+EC2_VARIABLES = HclTemplate('''
+variable "ami_id" {{
+  description = "AMI ID for the EC2 instance"
+  type        = string
+  default     = {ami}
+}}
+
+variable "instance_type" {{
+  description = "EC2 instance type"
+  type        = string
+  default     = {instance_type}
+}}
+
+variable "subnet_id" {{
+  description = "Subnet ID for the instance"
+  type        = string
+  default     = {subnet_id}
+}}
+
+variable "security_group_ids" {{
+  description = "List of security group IDs"
+  type        = list(string)
+  default     = {security_group_ids}
+}}
+
+variable "key_name" {{
+  description = "SSH key pair name"
+  type        = string
+  default     = {key_name}
+}}
+
+variable "associate_public_ip" {{
+  description = "Associate a public IP address"
+  type        = bool
+  default     = {associate_public_ip}
+}}
+
+variable "root_volume_size" {{
+  description = "Size of root volume in GB"
+  type        = number
+  default     = {root_volume_size}
+}}
+
+variable "root_volume_type" {{
+  description = "Type of root volume"
+  type        = string
+  default     = {root_volume_type}
+}}
+
+variable "instance_name" {{
+  description = "Name tag for the instance"
+  type        = string
+  default     = {instance_name}
+}}
+''')
+
+EC2_OUTPUTS = HclTemplate('''output "instance_id" {{
+  description = "ID of the EC2 instance"
+  value       = aws_instance.{resource_name}.id
+}}
+
+output "instance_public_ip" {{
+  description = "Public IP address of the instance"
+  value       = aws_instance.{resource_name}.public_ip
+}}
+
+output "instance_private_ip" {{
+  description = "Private IP address of the instance"
+  value       = aws_instance.{resource_name}.private_ip
+}}
+
+output "instance_arn" {{
+  description = "ARN of the EC2 instance"
+  value       = aws_instance.{resource_name}.arn
+}}
+''')
+
+S3_MAIN = HclTemplate('''# S3 Bucket Configuration
+resource "aws_s3_bucket" "{resource_name}" {{
+  bucket = var.bucket_name
+
+  tags = {{
+    Name        = var.bucket_name
+    Environment = var.environment
+    ManagedBy   = "Terraform"
+  }}
+}}
+
+resource "aws_s3_bucket_versioning" "{resource_name}_versioning" {{
+  bucket = aws_s3_bucket.{resource_name}.id
+
+  versioning_configuration {{
+    status = var.versioning_enabled ? "Enabled" : "Suspended"
+  }}
+}}
+''')
+
+S3_VARIABLES = HclTemplate('''
+variable "bucket_name" {{
+  description = "Name of the S3 bucket"
+  type        = string
+  default     = {bucket_name}
+}}
+
+variable "versioning_enabled" {{
+  description = "Enable bucket versioning"
+  type        = bool
+  default     = {versioning_enabled}
+}}
+''')
+
+S3_OUTPUTS = HclTemplate('''output "bucket_id" {{
+  description = "Name of the S3 bucket"
+  value       = aws_s3_bucket.{resource_name}.id
+}}
+
+output "bucket_arn" {{
+  description = "ARN of the S3 bucket"
+  value       = aws_s3_bucket.{resource_name}.arn
+}}
+
+output "bucket_domain_name" {{
+  description = "Domain name of the bucket"
+  value       = aws_s3_bucket.{resource_name}.bucket_domain_name
+}}
+''')
+
+# the ingress rules are streamed between the head and tail, one INGRESS_RULE each
+SECURITY_GROUP_MAIN_HEAD = HclTemplate('''# Security Group Configuration
+resource "aws_security_group" "{resource_name}" {{
+  name        = var.security_group_name
+  description = var.security_group_description
+  vpc_id      = var.vpc_id
+
+''')
+
+INGRESS_RULE = HclTemplate('''  ingress {{
+    from_port   = {from_port}
+    to_port     = {to_port}
+    protocol    = {protocol}
+    cidr_blocks = {cidr_blocks}
+  }}''')
+
+SECURITY_GROUP_MAIN_TAIL = HclTemplate('''
+
+  egress {{
+    from_port   = 0
+    to_port     = 0
+    protocol    = "-1"
+    cidr_blocks = ["0.0.0.0/0"]
+  }}
+
+  tags = {{
+    Name        = var.security_group_name
+    Environment = var.environment
+    ManagedBy   = "Terraform"
+  }}
+}}
+''')
+
+SECURITY_GROUP_VARIABLES = HclTemplate('''
+variable "security_group_name" {{
+  description = "Name of the security group"
+  type        = string
+  default     = {name}
+}}
+
+variable "security_group_description" {{
+  description = "Description of the security group"
+  type        = string
+  default     = {description}
+}}
+
+variable "vpc_id" {{
+  description = "VPC ID"
+  type        = string
+  default     = {vpc_id}
+}}
+''')
+
+SECURITY_GROUP_OUTPUTS = HclTemplate('''output "security_group_id" {{
+  description = "ID of the security group"
+  value       = aws_security_group.{resource_name}.id
+}}
+
+output "security_group_arn" {{
+  description = "ARN of the security group"
+  value       = aws_security_group.{resource_name}.arn
+}}
+''')
+
+
+# Consolidated exports: one block per resource with values inline and references to the
+# other exported resources, so a whole VPC shares a module and the root state
+MODULE_HEADER = HclTemplate('''# {module} exported by aws-mara-terraformer
+''')
+
+PROVIDER = HclTemplate('''provider "aws" {{
+  region = var.region
+}}
+''')
+
+MODULE_CALL = HclTemplate('''
+module "{module}" {{
+  source      = "./modules/{module}"
+  region      = var.region
+  environment = var.environment
+}}
+''')
+
+# names only repeat within a type, so the output name carries the type to stay unique in the module
+OUTPUT_ID = HclTemplate('''output "{resource_type}_{resource_name}_id" {{
+  value = {resource_type}.{resource_name}.id
+}}
+
+''')
+
+VPC_BLOCK = HclTemplate('''
+resource "aws_vpc" "{resource_name}" {{
+  cidr_block           = {cidr_block}
+  enable_dns_hostnames = {enable_dns_hostnames}
+  enable_dns_support   = {enable_dns_support}
+
+  tags = {tags}
+}}
+''')
+
+SUBNET_BLOCK = HclTemplate('''
+resource "aws_subnet" "{resource_name}" {{
+  vpc_id            = {vpc_id}
+  cidr_block        = {cidr_block}
+  availability_zone = {availability_zone}
+
+  tags = {tags}
+}}
+''')
+
+SECURITY_GROUP_BLOCK_HEAD = HclTemplate('''
+resource "aws_security_group" "{resource_name}" {{
+  name        = {name}
+  description = {description}
+  vpc_id      = {vpc_id}
+''')
+
+SECURITY_GROUP_BLOCK_TAIL = HclTemplate('''
+  egress {{
+    from_port   = 0
+    to_port     = 0
+    protocol    = "-1"
+    cidr_blocks = ["0.0.0.0/0"]
+  }}
+
+  tags = {tags}
+}}
+''')
+
+INSTANCE_BLOCK = HclTemplate('''
+resource "aws_instance" "{resource_name}" {{
+  ami                         = {ami}
+  instance_type               = {instance_type}
+  subnet_id                   = {subnet_id}
+  vpc_security_group_ids      = {security_group_ids}
+  key_name                    = {key_name}
+  associate_public_ip_address = {associate_public_ip}
+
+  root_block_device {{
+    volume_size = {root_volume_size}
+    volume_type = {root_volume_type}
+  }}
+
+  tags = {tags}
+}}
+''')
+
+BUCKET_BLOCK = HclTemplate('''
+resource "aws_s3_bucket" "{resource_name}" {{
+  bucket = {bucket_name}
+
+  tags = {tags}
+}}
+
+resource "aws_s3_bucket_versioning" "{resource_name}" {{
+  bucket = aws_s3_bucket.{resource_name}.id
+
+  versioning_configuration {{
+    status = {versioning_status}
+  }}
+}}
+''')
+
+# the bucket's own rules are streamed after each head with hcl_block, then the resource is closed with "}}"
+BUCKET_ENCRYPTION_HEAD = HclTemplate('''
+resource "aws_s3_bucket_server_side_encryption_configuration" "{resource_name}" {{
+  bucket = aws_s3_bucket.{bucket_resource}.id
+
+''')
+
+BUCKET_LIFECYCLE_HEAD = HclTemplate('''
+resource "aws_s3_bucket_lifecycle_configuration" "{resource_name}" {{
+  bucket = aws_s3_bucket.{bucket_resource}.id
+
+''')
+
+BUCKET_POLICY_BLOCK = HclTemplate('''
+resource "aws_s3_bucket_policy" "{resource_name}" {{
+  bucket = aws_s3_bucket.{resource_name}.id
+  policy = {policy}
+}}
+''')
+
+BUCKET_LOGGING_BLOCK = HclTemplate('''
+resource "aws_s3_bucket_logging" "{resource_name}" {{
+  bucket        = aws_s3_bucket.{resource_name}.id
+  target_bucket = {target_bucket}
+  target_prefix = {target_prefix}
+}}
+''')
@@ -5,55 +5,442 @@ Converts existing AWS resources into Terraform IaC files
 """
 
 import boto3
+import cProfile
 import json
 import argparse
+import hashlib
+import inspect
+import re
+import shutil
+import sqlite3
 import sys
+import threading
+import time
+import zlib
+from botocore.exceptions import ClientError
+from collections import Counter, defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
 
+from hcl import (BUCKET_BLOCK, BUCKET_ENCRYPTION_HEAD, BUCKET_LIFECYCLE_HEAD, BUCKET_LOGGING_BLOCK,
+                 BUCKET_POLICY_BLOCK, EC2_MAIN, EC2_OUTPUTS, EC2_VARIABLES, INGRESS_RULE, INSTANCE_BLOCK, MODULE_CALL,
+                 MODULE_HEADER, OUTPUT_ID, PROVIDER, S3_MAIN, S3_OUTPUTS, S3_VARIABLES, SECURITY_GROUP_BLOCK_HEAD,
+                 SECURITY_GROUP_BLOCK_TAIL, SECURITY_GROUP_MAIN_HEAD, SECURITY_GROUP_MAIN_TAIL, SECURITY_GROUP_OUTPUTS,
+                 SECURITY_GROUP_VARIABLES, SUBNET_BLOCK, TEMPLATES_FINGERPRINT, VPC_BLOCK, HclMap, ModuleWriter,
+                 hcl, hcl_block)
+
+
+# boto3 clients are thread safe, so bulk exports share one generator across the pool
+BULK_WORKERS = 16
+# per-bucket get_bucket_* calls, shared by every bucket being exported
+S3_CONFIG_WORKERS = 32
+# bucket setting -> (get_bucket_* call, error codes that mean the setting is simply not configured)
+BUCKET_CONFIG_CALLS = {
+    'versioning': ('get_bucket_versioning', ()),
+    'encryption': ('get_bucket_encryption', ('ServerSideEncryptionConfigurationNotFoundError',)),
+    'lifecycle': ('get_bucket_lifecycle_configuration', ('NoSuchLifecycleConfiguration',)),
+    'policy': ('get_bucket_policy', ('NoSuchBucketPolicy',)),
+    'tags': ('get_bucket_tagging', ('NoSuchTagSet',)),
+    'logging': ('get_bucket_logging', ()),
+}
+# the settings the per-resource S3 module renders, the only ones it fetches
+MODULE_BUCKET_SETTINGS = ('versioning', 'encryption', 'lifecycle')
+# listing api -> the per-resource apis whose cached responses go with a listed ID. A listing caches its entries
+# under its own name too, and describe_* listings are the per-resource api as well
+LISTED_APIS = {
+    'list_buckets': tuple(api for api, _ in BUCKET_CONFIG_CALLS.values()),
+}
+# the setting can't be read with these credentials, it is exported as not configured and reported
+UNREADABLE_CODES = ('AccessDenied', 'AllAccessDisabled', 'MethodNotAllowed')
+# EC2 caps a describe filter at 200 values, unknown IDs in a filter are skipped rather than failing the call
+DESCRIBE_FILTER_LIMIT = 200
+# types render() has templates for, anything else is skipped by bulk and discovery exports
+RENDERED_TYPES = ('ec2_instance', 's3_bucket', 'security_group')
+# consolidated exports also write the network they reference, in this order within a module
+TERRAFORM_TYPES = {
+    'vpc': 'aws_vpc',
+    'subnet': 'aws_subnet',
+    'security_group': 'aws_security_group',
+    'ec2_instance': 'aws_instance',
+    's3_bucket': 'aws_s3_bucket',
+}
+BUCKETS_MODULE = 's3'
+# EC2 ID prefixes, matched only when followed by an 8 or 17 digit hex ID so bucket names like vpc-logs don't match
+ID_PREFIXES = (
+    ('i-', 'ec2_instance'),
+    ('vpc-', 'vpc'),
+    ('subnet-', 'subnet'),
+    ('sg-', 'security_group'),
+    ('igw-', 'internet_gateway'),
+    ('nat-', 'nat_gateway'),
+    ('rtb-', 'route_table'),
+    ('vol-', 'ebs_volume'),
+    ('ami-', 'ami'),
+)
+ID_PREFIX_TYPES = dict(ID_PREFIXES)
+ID_PATTERN = re.compile(
+    r'^({})[0-9a-f]{{8}}(?:[0-9a-f]{{9}})?$'.format('|'.join(re.escape(prefix) for prefix, _ in ID_PREFIXES))
+)
+# (service, resource prefix, type) matched in order against arn:partition:service:region:account:resource
+ARN_TYPES = (
+    ('ec2', 'instance/', 'ec2_instance'),
+    ('ec2', 'security-group/', 'security_group'),
+    ('ec2', 'vpc/', 'vpc'),
+    ('ec2', 'subnet/', 'subnet'),
+    ('ec2', 'internet-gateway/', 'internet_gateway'),
+    ('ec2', 'natgateway/', 'nat_gateway'),
+    ('ec2', 'route-table/', 'route_table'),
+    ('ec2', 'volume/', 'ebs_volume'),
+    ('ec2', 'image/', 'ami'),
+    ('rds', 'db:', 'rds_instance'),
+    ('elasticloadbalancing', 'loadbalancer/', 'load_balancer'),
+    ('s3', '', 's3_bucket'),
+)
+BUCKET_NAME = re.compile(r'^[a-z0-9][a-z0-9.-]{1,61}[a-z0-9]$')
+FINGERPRINTS_FILE = '.terraformer-fingerprints.json'
+CACHE_DB = Path.home() / '.cache' / 'aws-mara-terraformer' / 'describe.sqlite'
+CACHE_TTL = 3600
+
+
+def read_resource_ids(source):
+    """Read resource IDs one per line from a file, or stdin for '-'"""
+    handle = sys.stdin if source == '-' else open(source)
+    try:
+        ids = [line.strip() for line in handle]
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+    # keep input order, drop blanks, comments and repeats
+    return list(dict.fromkeys(i for i in ids if i and not i.startswith('#')))
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def parse_arn(arn):
+    """(resource_type, resource_id) for an ARN, or (None, arn). EC2 and S3 ARNs come back as the bare
+    ID their describe calls take, RDS and ELB APIs take the ARN itself"""
+    parts = arn.split(':', 5)
+    if len(parts) != 6:
+        return None, arn
+    service, resource = parts[2], parts[5]
+    for arn_service, prefix, resource_type in ARN_TYPES:
+        if service != arn_service or not resource.startswith(prefix):
+            continue
+        if service == 's3':
+            # arn:aws:s3:::bucket, object ARNs have a key after the bucket
+            return (resource_type, resource) if BUCKET_NAME.match(resource) else (None, arn)
+        if service == 'ec2':
+            return resource_type, resource[len(prefix):]
+        return resource_type, arn
+    return None, arn
+
+
+def instance_entries(page):
+    return ((i['InstanceId'], i) for reservation in page['Reservations'] for i in reservation['Instances'])
+
+
+def security_group_entries(page):
+    return ((sg['GroupId'], sg) for sg in page['SecurityGroups'])
+
+
+def vpc_entries(page):
+    return ((vpc['VpcId'], vpc) for vpc in page['Vpcs'])
+
+
+def subnet_entries(page):
+    return ((subnet['SubnetId'], subnet) for subnet in page['Subnets'])
+
+
+def bucket_entries(page):
+    return ((bucket['Name'], bucket) for bucket in page['Buckets'])
+
+
+def db_instance_entries(page):
+    return ((db['DBInstanceArn'], db) for db in page['DBInstances'])
+
+
+def load_balancer_entries(page):
+    return ((lb['LoadBalancerArn'], lb) for lb in page['LoadBalancers'])
+
+
+def module_dir_name(resource_id):
+    """Directory-safe name for a resource ID or ARN"""
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', resource_id)
+
+
+def normalize(value):
+    """Describe data with dict keys and list order made canonical, so a reordered AWS response isn't drift"""
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in sorted(value.items())}
+    if isinstance(value, list):
+        return sorted((normalize(item) for item in value), key=lambda item: json.dumps(item, default=str))
+    return value
+
+
+def resource_key(resource_type, resource_id):
+    return f'{resource_type}/{resource_id}'
+
+
+class Fingerprints:
+    """Fingerprints of the payloads last rendered into an output directory, per resource and per
+    consolidated module, used to rewrite only what drifted"""
+    
+    def __init__(self, output_path):
+        self.path = output_path / FINGERPRINTS_FILE
+        saved = json.loads(self.path.read_text()) if self.path.exists() else {}
+        self.resources = saved.get('resources', {})
+        self.modules = saved.get('modules', {})
+        # resource key -> consolidated module it was written to
+        self.placement = saved.get('placement', {})
+    
+    def save(self, resources, modules=None, placement=None):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        saved = {'resources': resources, 'modules': modules or {}, 'placement': placement or {}}
+        partial_path = self.path.with_suffix('.tmp')
+        partial_path.write_text(json.dumps(saved, sort_keys=True))
+        partial_path.replace(self.path)
+
+
+def report_drift(output_dir, added, changed, removed, unchanged):
+    print(f"\n✓ {len(added)} added, {len(changed)} changed, {len(removed)} removed, "
+          f"{unchanged} unchanged in {output_dir}/")
+    for resource in removed:
+        print(f"  - {resource} (removed)")
+
+
+def terraform_name(value):
+    """Terraform identifier for a tag, name or ID"""
+    name = re.sub(r'[^a-z0-9_]', '_', value.lower())
+    return name if re.match(r'[a-z_]', name) else f'_{name}'
+
+
+def terraform_tags(tags):
+    # aws: prefixed tags are reserved and can't be managed
+    managed = {key: value for key, value in tags.items() if not key.startswith('aws:')}
+    managed['ManagedBy'] = 'Terraform'
+    return managed
+
+
+def rfc3339(value):
+    """Lifecycle dates as Terraform wants them, from a datetime or its cached str()"""
+    text = value if isinstance(value, str) else value.isoformat()
+    return text.replace(' ', 'T').replace('+00:00', 'Z')
+
+
+def encryption_rule_blocks(rules):
+    """hcl_block bodies for a bucket's get_bucket_encryption rules"""
+    return [{
+        'apply_server_side_encryption_by_default': {
+            'sse_algorithm': rule['ApplyServerSideEncryptionByDefault']['SSEAlgorithm'],
+            'kms_master_key_id': rule['ApplyServerSideEncryptionByDefault'].get('KMSMasterKeyID'),
+        },
+        'bucket_key_enabled': rule.get('BucketKeyEnabled'),
+    } for rule in rules if 'ApplyServerSideEncryptionByDefault' in rule]
+
+
+def lifecycle_filter(rule):
+    """The filter block of a lifecycle rule, rules from before filters existed carry a bare Prefix"""
+    if 'Filter' not in rule:
+        return {'prefix': rule.get('Prefix', '')}
+    source = rule['Filter']
+    if 'And' in source:
+        source = source['And']
+        tags = HclMap((tag['Key'], tag['Value']) for tag in source.get('Tags', []))
+        return {'and': {
+            'prefix': source.get('Prefix'),
+            'tags': tags or None,
+            'object_size_greater_than': source.get('ObjectSizeGreaterThan'),
+            'object_size_less_than': source.get('ObjectSizeLessThan'),
+        }}
+    return {
+        'prefix': source.get('Prefix'),
+        'tag': {'key': source['Tag']['Key'], 'value': source['Tag']['Value']} if 'Tag' in source else None,
+        'object_size_greater_than': source.get('ObjectSizeGreaterThan'),
+        'object_size_less_than': source.get('ObjectSizeLessThan'),
+    }
+
+
+def lifecycle_rule_blocks(rules):
+    """hcl_block bodies for a bucket's get_bucket_lifecycle_configuration rules"""
+    blocks = []
+    for rule in rules:
+        expiration = rule.get('Expiration')
+        noncurrent = rule.get('NoncurrentVersionExpiration')
+        abort = rule.get('AbortIncompleteMultipartUpload')
+        blocks.append({
+            'id': rule.get('ID'),
+            'status': rule['Status'],
+            'filter': lifecycle_filter(rule),
+            'expiration': expiration and {
+                'days': expiration.get('Days'),
+                'date': expiration.get('Date') and rfc3339(expiration['Date']),
+                'expired_object_delete_marker': expiration.get('ExpiredObjectDeleteMarker'),
+            },
+            'transition': [{
+                'days': transition.get('Days'),
+                'date': transition.get('Date') and rfc3339(transition['Date']),
+                'storage_class': transition['StorageClass'],
+            } for transition in rule.get('Transitions', [])],
+            'noncurrent_version_expiration': noncurrent and {
+                'noncurrent_days': noncurrent.get('NoncurrentDays'),
+                'newer_noncurrent_versions': noncurrent.get('NewerNoncurrentVersions'),
+            },
+            'noncurrent_version_transition': [{
+                'noncurrent_days': transition.get('NoncurrentDays'),
+                'newer_noncurrent_versions': transition.get('NewerNoncurrentVersions'),
+                'storage_class': transition['StorageClass'],
+            } for transition in rule.get('NoncurrentVersionTransitions', [])],
+            'abort_incomplete_multipart_upload': abort and {'days_after_initiation': abort['DaysAfterInitiation']},
+        })
+    return blocks
+
+
+def write_bucket_rules(handle, data, bucket_resource, encryption_name, lifecycle_name):
+    """The encryption and lifecycle resources of a bucket, each only when the bucket has rules for it"""
+    for head, name, blocks in (
+        (BUCKET_ENCRYPTION_HEAD, encryption_name, encryption_rule_blocks(data['encryption_rules'])),
+        (BUCKET_LIFECYCLE_HEAD, lifecycle_name, lifecycle_rule_blocks(data['lifecycle_rules'])),
+    ):
+        if not blocks:
+            continue
+        head.render(handle, {'resource_name': name, 'bucket_resource': bucket_resource})
+        for block in blocks:
+            hcl_block(handle, 'rule', block)
+        handle.write('}\n')
+
+
+class DescribeCache:
+    """AWS responses keyed by (region, api, resource_id), stored as zlib compressed JSON in SQLite.
+    refresh skips reads but still stores, offline never lets a miss reach AWS"""
+    
+    def __init__(self, path=CACHE_DB, ttl=CACHE_TTL, offline=False, refresh=False):
+        self.ttl = ttl
+        self.offline = offline
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+            region TEXT NOT NULL,
+            api TEXT NOT NULL,
+            resource_id TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            body BLOB NOT NULL,
+            PRIMARY KEY (region, api, resource_id)
+        )''')
+        self.db.commit()
+    
+    def fresh_after(self):
+        # offline runs use whatever is cached, however old
+        return 0 if self.offline else time.time() - self.ttl
+    
+    def get(self, region, api, resource_id):
+        if self.refresh:
+            return None
+        with self.lock:
+            row = self.db.execute(
+                'SELECT body FROM responses WHERE region = ? AND api = ? AND resource_id = ? AND fetched_at >= ?',
+                (region, api, resource_id, self.fresh_after())
+            ).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+    
+    def entries(self, region, api):
+        """Every cached (resource_id, body) for an api, used by offline discovery"""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT resource_id, body FROM responses WHERE region = ? AND api = ? AND fetched_at >= ? '
+                'ORDER BY resource_id',
+                (region, api, self.fresh_after())
+            ).fetchall()
+        return [(resource_id, json.loads(zlib.decompress(body))) for resource_id, body in rows]
+    
+    def stale(self, region, api):
+        """How many cached entries for an api are older than the TTL"""
+        with self.lock:
+            return self.db.execute(
+                'SELECT COUNT(*) FROM responses WHERE region = ? AND api = ? AND fetched_at < ?',
+                (region, api, time.time() - self.ttl)
+            ).fetchone()[0]
+    
+    def evict(self, region, apis, keep_ids):
+        """Drop the cached responses of apis for every resource_id not in keep_ids, returns how many IDs went"""
+        with self.lock:
+            gone = [
+                row for row in self.db.execute(
+                    'SELECT DISTINCT api, resource_id FROM responses WHERE region = ? AND api IN ({})'.format(
+                        ', '.join('?' * len(apis))),
+                    (region, *apis)
+                ).fetchall()
+                if row[1] not in keep_ids
+            ]
+            self.db.executemany('DELETE FROM responses WHERE region = ? AND api = ? AND resource_id = ?',
+                                [(region, api, resource_id) for api, resource_id in gone])
+            self.db.commit()
+        return len({resource_id for _, resource_id in gone})
+    
+    def put(self, region, api, bodies):
+        """Store [(resource_id, body)] for an api"""
+        now = time.time()
+        rows = [(region, api, resource_id, now, zlib.compress(json.dumps(body, default=str).encode()))
+                for resource_id, body in bodies]
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', rows)
+            self.db.commit()
+
 
 class TerraformGenerator:
-    def __init__(self, region='us-east-1'):
+    def __init__(self, region='us-east-1', cache=None, rewrite_all=False):
         self.region = region
+        self.cache = cache
+        # ignore stored fingerprints and rewrite every module
+        self.rewrite_all = rewrite_all
         self.ec2 = boto3.client('ec2', region_name=region)
         self.rds = boto3.client('rds', region_name=region)
         self.s3 = boto3.client('s3', region_name=region)
         self.elb = boto3.client('elbv2', region_name=region)
+        # (resource_type, resource_id) -> data from prefetch(), None for IDs the batch did not find
+        self.prefetched = {}
+        # names from one unfiltered list_buckets, taken the first time an unprefixed ID needs it. A bucket is
+        # classified whatever its region, only discover() keeps to this one
+        self.bucket_names = None
+        self.s3_pool = ThreadPoolExecutor(max_workers=S3_CONFIG_WORKERS)
         
-    def identify_resource_type(self, resource_id):
-        """Determine AWS resource type from ID pattern"""
-        prefix_map = {
-            'i-': 'ec2_instance',
-            'vpc-': 'vpc',
-            'subnet-': 'subnet',
-            'sg-': 'security_group',
-            'igw-': 'internet_gateway',
-            'nat-': 'nat_gateway',
-            'rtb-': 'route_table',
-            'vol-': 'ebs_volume',
-            'ami-': 'ami',
-            'arn:aws:rds': 'rds_instance',
-            'arn:aws:s3': 's3_bucket',
-        }
+    def classify(self, resource_id):
+        """(resource_type, resource_id) from the ID or ARN alone, ARNs reduced to the ID their API takes.
+        Unprefixed names are looked up in the bucket snapshot, the only call this can make"""
+        match = ID_PATTERN.match(resource_id)
+        if match:
+            return ID_PREFIX_TYPES[match.group(1)], resource_id
         
-        for prefix, resource_type in prefix_map.items():
-            if resource_id.startswith(prefix):
-                return resource_type
+        if resource_id.startswith('arn:'):
+            return parse_arn(resource_id)
         
-        # Check if it's an S3 bucket name (no prefix)
-        if not resource_id.startswith(('i-', 'vpc-', 'subnet-', 'sg-', 'arn:')):
-            try:
-                self.s3.head_bucket(Bucket=resource_id)
-                return 's3_bucket'
-            except:
-                pass
-                
-        return None
+        if BUCKET_NAME.match(resource_id):
+            if self.bucket_names is None:
+                self.bucket_names = {
+                    bucket_name for bucket_name, _ in self.describe_all(
+                        self.s3, 'list_buckets', bucket_entries, cached_as='list_buckets_all')
+                }
+            if resource_id in self.bucket_names:
+                return 's3_bucket', resource_id
+        
+        return None, resource_id
+    
+    def identify_resource_type(self, resource_id):
+        """Determine AWS resource type from ID pattern"""
+        return self.classify(resource_id)[0]
     
     def get_ec2_instance(self, instance_id):
         """Retrieve EC2 instance details"""
-        response = self.ec2.describe_instances(InstanceIds=[instance_id])
-        instance = response['Reservations'][0]['Instances'][0]
-        
+        instance = self.cached('describe_instances', instance_id, lambda: self.ec2.describe_instances(
+            InstanceIds=[instance_id])['Reservations'][0]['Instances'][0])
+        return self.ec2_instance_data(instance)
+    
+    def ec2_instance_data(self, instance):
+        """Pick the fields the EC2 template needs out of a describe_instances entry"""
         tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
         
         return {
@@ -66,17 +453,21 @@ class TerraformGenerator:
             'private_ip': instance.get('PrivateIpAddress', ''),
             'tags': tags,
             'root_block_device': {
-                'volume_size': instance['BlockDeviceMappings'][0]['Ebs']['VolumeSize'] if instance.get('BlockDeviceMappings') else 8,
+                'volume_size': instance['BlockDeviceMappings'][0]['Ebs'].get('VolumeSize', 8) if instance.get('BlockDeviceMappings') else 8,
                 'volume_type': 'gp3',
             },
             'associate_public_ip_address': instance.get('PublicIpAddress') is not None,
+            'vpc_id': instance.get('VpcId', ''),
         }
     
     def get_security_group(self, sg_id):
         """Retrieve Security Group details"""
-        response = self.ec2.describe_security_groups(GroupIds=[sg_id])
-        sg = response['SecurityGroups'][0]
-        
+        sg = self.cached('describe_security_groups', sg_id, lambda: self.ec2.describe_security_groups(
+            GroupIds=[sg_id])['SecurityGroups'][0])
+        return self.security_group_data(sg)
+    
+    def security_group_data(self, sg):
+        """Pick the fields the security group template needs out of a describe_security_groups entry"""
         return {
             'name': sg['GroupName'],
             'description': sg['Description'],
@@ -86,29 +477,63 @@ class TerraformGenerator:
             'tags': {tag['Key']: tag['Value'] for tag in sg.get('Tags', [])}
         }
     
-    def get_s3_bucket(self, bucket_name):
-        """Retrieve S3 bucket configuration"""
+    def get_bucket_config(self, bucket_name, setting):
+        """One get_bucket_* response, {} when the setting isn't configured, None when it can't be read.
+        A missing bucket, throttling that outlasted botocore's retries or any other error is raised"""
+        api, not_configured_codes = BUCKET_CONFIG_CALLS[setting]
+        
+        def call():
+            try:
+                return getattr(self.s3, api)(Bucket=bucket_name)
+            except ClientError as e:
+                if e.response['Error']['Code'] in not_configured_codes:
+                    # cached like any other answer, it is one
+                    return {}
+                raise
+        
         try:
-            versioning = self.s3.get_bucket_versioning(Bucket=bucket_name)
-            encryption = self.s3.get_bucket_encryption(Bucket=bucket_name)
-            
-            return {
-                'bucket_name': bucket_name,
-                'versioning_enabled': versioning.get('Status') == 'Enabled',
-                'encryption_enabled': 'Rules' in encryption,
-            }
-        except Exception as e:
-            return {
-                'bucket_name': bucket_name,
-                'versioning_enabled': False,
-                'encryption_enabled': False,
-            }
+            return self.cached(api, bucket_name, call)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'NoSuchBucket':
+                raise LookupError(f"{bucket_name} not found") from e
+            if code in UNREADABLE_CODES:
+                return None
+            raise
+    
+    def get_s3_bucket(self, bucket_name, settings=tuple(BUCKET_CONFIG_CALLS)):
+        """Retrieve S3 bucket configuration, the requested settings fetched concurrently on the S3 pool.
+        Settings not requested are returned as not configured"""
+        futures = {
+            setting: self.s3_pool.submit(self.get_bucket_config, bucket_name, setting)
+            for setting in settings
+        }
+        config = {setting: future.result() for setting, future in futures.items()}
+        unreadable = sorted(setting for setting, response in config.items() if response is None)
+        if unreadable:
+            print(f"  ! {bucket_name}: no access to {', '.join(unreadable)}, exported as not configured")
+        config = {setting: config.get(setting) or {} for setting in BUCKET_CONFIG_CALLS}
+        
+        encryption_rules = config['encryption'].get('ServerSideEncryptionConfiguration', {}).get('Rules', [])
+        return {
+            'bucket_name': bucket_name,
+            'versioning_enabled': config['versioning'].get('Status') == 'Enabled',
+            'encryption_enabled': bool(encryption_rules),
+            'encryption_rules': encryption_rules,
+            'lifecycle_rules': config['lifecycle'].get('Rules', []),
+            'policy': config['policy'].get('Policy'),
+            'tags': {tag['Key']: tag['Value'] for tag in config['tags'].get('TagSet', [])},
+            'logging': config['logging'].get('LoggingEnabled'),
+            'unreadable': unreadable,
+        }
     
     def get_vpc(self, vpc_id):
         """Retrieve VPC details"""
-        response = self.ec2.describe_vpcs(VpcIds=[vpc_id])
-        vpc = response['Vpcs'][0]
-        
+        vpc = self.cached('describe_vpcs', vpc_id, lambda: self.ec2.describe_vpcs(VpcIds=[vpc_id])['Vpcs'][0])
+        return self.vpc_data(vpc)
+    
+    def vpc_data(self, vpc):
+        """Pick the VPC fields out of a describe_vpcs entry"""
         return {
             'cidr_block': vpc['CidrBlock'],
             'enable_dns_hostnames': vpc.get('EnableDnsHostnames', True),
@@ -116,288 +541,283 @@ class TerraformGenerator:
             'tags': {tag['Key']: tag['Value'] for tag in vpc.get('Tags', [])}
         }
     
-    def generate_ec2_terraform(self, resource_id, data):
-        """Generate Terraform files for EC2 instance"""
+    def cached(self, api, resource_id, call):
+        """Response for (api, resource_id) from the describe cache, calling AWS on a miss"""
+        if self.cache is None:
+            return call()
+        body = self.cache.get(self.region, api, resource_id)
+        if body is None:
+            if self.cache.offline:
+                raise LookupError(f"{resource_id} is not in the describe cache ({api}), rerun without --offline")
+            body = call()
+            body.pop('ResponseMetadata', None)
+            self.cache.put(self.region, api, [(resource_id, body)])
+        return body
+    
+    def describe_batched(self, api, id_filter, entries, resource_ids):
+        """Raw describe entries for resource_ids, from the cache where fresh, otherwise in paginated
+        calls filtered on DESCRIBE_FILTER_LIMIT IDs at a time. Returns {resource_id: entry}"""
+        found = {}
+        missing = resource_ids
+        if self.cache is not None:
+            cached = {resource_id: self.cache.get(self.region, api, resource_id) for resource_id in resource_ids}
+            found = {resource_id: entry for resource_id, entry in cached.items() if entry is not None}
+            missing = [resource_id for resource_id in resource_ids if resource_id not in found]
+            if self.cache.offline:
+                missing = []
+        
+        paginator = self.ec2.get_paginator(api)
+        for chunk in chunked(missing, DESCRIBE_FILTER_LIMIT):
+            for page in paginator.paginate(Filters=[{'Name': id_filter, 'Values': chunk}]):
+                page_entries = list(entries(page))
+                found.update(page_entries)
+                if self.cache is not None:
+                    self.cache.put(self.region, api, page_entries)
+        return found
+    
+    def describe_all(self, client, api, entries, cached_as=None, **params):
+        """Yield (resource_id, entry) for every resource an api lists in the region, a page at a time.
+        Entries are cached under cached_as, default api, and offline runs replay the cache instead.
+        A listing that runs to the end evicts the cached responses of every ID it no longer returns"""
+        cached_as = cached_as or api
+        if self.cache is not None and self.cache.offline:
+            stale = self.cache.stale(self.region, cached_as)
+            if stale:
+                print(f"  ! {stale} cached {cached_as} entries are older than {self.cache.ttl}s, resources deleted "
+                      f"since are still exported until a run without --offline")
+            yield from self.cache.entries(self.region, cached_as)
+            return
+        listed = set()
+        for page in client.get_paginator(api).paginate(**params):
+            page_entries = list(entries(page))
+            if self.cache is not None:
+                self.cache.put(self.region, cached_as, page_entries)
+            listed.update(resource_id for resource_id, _ in page_entries)
+            yield from page_entries
+        if self.cache is not None:
+            self.cache.evict(self.region, (cached_as, *LISTED_APIS.get(api, ())), listed)
+    
+    def get_subnet(self, subnet_id):
+        """Retrieve Subnet details"""
+        subnet = self.cached('describe_subnets', subnet_id, lambda: self.ec2.describe_subnets(
+            SubnetIds=[subnet_id])['Subnets'][0])
+        return self.subnet_data(subnet)
+    
+    def subnet_data(self, subnet):
+        """Pick the subnet fields out of a describe_subnets entry"""
+        return {
+            'vpc_id': subnet['VpcId'],
+            'cidr_block': subnet['CidrBlock'],
+            'availability_zone': subnet['AvailabilityZone'],
+            'tags': {tag['Key']: tag['Value'] for tag in subnet.get('Tags', [])}
+        }
+    
+    def describe_ec2_instances(self, instance_ids):
+        """Batched describe_instances, returns {instance_id: data}"""
+        found = self.describe_batched('describe_instances', 'instance-id', instance_entries, instance_ids)
+        return {instance_id: self.ec2_instance_data(instance) for instance_id, instance in found.items()}
+    
+    def describe_security_groups(self, sg_ids):
+        """Batched describe_security_groups, returns {group_id: data}"""
+        found = self.describe_batched('describe_security_groups', 'group-id', security_group_entries, sg_ids)
+        return {sg_id: self.security_group_data(sg) for sg_id, sg in found.items()}
+    
+    def describe_vpcs(self, vpc_ids):
+        """Batched describe_vpcs, returns {vpc_id: data}"""
+        found = self.describe_batched('describe_vpcs', 'vpc-id', vpc_entries, vpc_ids)
+        return {vpc_id: self.vpc_data(vpc) for vpc_id, vpc in found.items()}
+    
+    def describe_subnets(self, subnet_ids):
+        """Batched describe_subnets, returns {subnet_id: data}"""
+        found = self.describe_batched('describe_subnets', 'subnet-id', subnet_entries, subnet_ids)
+        return {subnet_id: self.subnet_data(subnet) for subnet_id, subnet in found.items()}
+    
+    def prefetch(self, resource_ids):
+        """Classify resource IDs and describe each batchable type in bulk.
+        Returns [(resource_type, resource_id)] in input order, ARNs reduced to IDs"""
+        resources = list(dict.fromkeys(self.classify(resource_id) for resource_id in resource_ids))
+        self.batch_describe(resources)
+        return resources
+    
+    def batch_describe(self, resources):
+        """Describe each batchable type of [(resource_type, resource_id)] in bulk into self.prefetched"""
+        by_type = defaultdict(list)
+        for resource_type, resource_id in resources:
+            by_type[resource_type].append(resource_id)
+        
+        batch_describes = {
+            'ec2_instance': self.describe_ec2_instances,
+            'security_group': self.describe_security_groups,
+            'vpc': self.describe_vpcs,
+            'subnet': self.describe_subnets,
+        }
+        for resource_type, describe in batch_describes.items():
+            if not by_type[resource_type]:
+                continue
+            found = describe(by_type[resource_type])
+            for resource_id in by_type[resource_type]:
+                self.prefetched[(resource_type, resource_id)] = found.get(resource_id)
+    
+    def discover(self):
+        """Yield (resource_type, resource_id) for every resource in the region, one page at a time.
+        Describe data for each page is parked in self.prefetched until fetch() hands it to a generator"""
+        for instance_id, instance in self.describe_all(self.ec2, 'describe_instances', instance_entries):
+            if instance['State']['Name'] == 'terminated':
+                continue
+            self.prefetched[('ec2_instance', instance_id)] = self.ec2_instance_data(instance)
+            yield 'ec2_instance', instance_id
+        
+        for sg_id, sg in self.describe_all(self.ec2, 'describe_security_groups', security_group_entries):
+            self.prefetched[('security_group', sg_id)] = self.security_group_data(sg)
+            yield 'security_group', sg_id
+        
+        for vpc_id, vpc in self.describe_all(self.ec2, 'describe_vpcs', vpc_entries):
+            self.prefetched[('vpc', vpc_id)] = self.vpc_data(vpc)
+            yield 'vpc', vpc_id
+        
+        for subnet_id, subnet in self.describe_all(self.ec2, 'describe_subnets', subnet_entries):
+            self.prefetched[('subnet', subnet_id)] = self.subnet_data(subnet)
+            yield 'subnet', subnet_id
+        
+        # bucket configuration is per-bucket calls anyway, get_s3_bucket runs them on the export pool
+        for bucket_name, _ in self.describe_all(self.s3, 'list_buckets', bucket_entries, BucketRegion=self.region):
+            yield 's3_bucket', bucket_name
+        
+        for db_arn, _ in self.describe_all(self.rds, 'describe_db_instances', db_instance_entries):
+            yield 'rds_instance', db_arn
+        
+        for lb_arn, _ in self.describe_all(self.elb, 'describe_load_balancers', load_balancer_entries):
+            yield 'load_balancer', lb_arn
+    
+    def fetch(self, resource_type, resource_id, get):
+        """Data for a resource, from prefetch() when it was batched, else one get_* call"""
+        key = (resource_type, resource_id)
+        if key not in self.prefetched:
+            return get(resource_id)
+        data = self.prefetched.pop(key)
+        if data is None:
+            raise LookupError(f"{resource_id} not found in {self.region}")
+        return data
+    
+    def generate_ec2_terraform(self, writer, resource_id, data):
+        """Write the Terraform blocks for an EC2 instance"""
         resource_name = data['tags'].get('Name', resource_id).replace(' ', '_').replace('-', '_').lower()
         
-        main_tf = f'''# EC2 Instance Configuration
-resource "aws_instance" "{resource_name}" {{
-  ami                         = var.ami_id
-  instance_type              = var.instance_type
-  subnet_id                  = var.subnet_id
-  vpc_security_group_ids     = var.security_group_ids
-  key_name                   = var.key_name
-  associate_public_ip_address = var.associate_public_ip
-
-  root_block_device {{
-    volume_size = var.root_volume_size
-    volume_type = var.root_volume_type
-  }}
-
-  tags = {{
-    Name        = var.instance_name
-    Environment = var.environment
-    ManagedBy   = "Terraform"
-  }}
-}}
-'''
-        
-        variables_tf = f'''variable "region" {{
-  description = "AWS region"
-  type        = string
-  default     = "{self.region}"
-}}
-
-variable "ami_id" {{
-  description = "AMI ID for the EC2 instance"
-  type        = string
-  default     = "{data['ami']}"
-}}
-
-variable "instance_type" {{
-  description = "EC2 instance type"
-  type        = string
-  default     = "{data['instance_type']}"
-}}
-
-variable "subnet_id" {{
-  description = "Subnet ID for the instance"
-  type        = string
-  default     = "{data['subnet_id']}"
-}}
-
-variable "security_group_ids" {{
-  description = "List of security group IDs"
-  type        = list(string)
-  default     = {json.dumps(data['vpc_security_group_ids'])}
-}}
-
-variable "key_name" {{
-  description = "SSH key pair name"
-  type        = string
-  default     = "{data['key_name']}"
-}}
-
-variable "associate_public_ip" {{
-  description = "Associate a public IP address"
-  type        = bool
-  default     = {str(data['associate_public_ip_address']).lower()}
-}}
-
-variable "root_volume_size" {{
-  description = "Size of root volume in GB"
-  type        = number
-  default     = {data['root_block_device']['volume_size']}
-}}
-
-variable "root_volume_type" {{
-  description = "Type of root volume"
-  type        = string
-  default     = "{data['root_block_device']['volume_type']}"
-}}
-
-variable "instance_name" {{
-  description = "Name tag for the instance"
-  type        = string
-  default     = "{data['tags'].get('Name', resource_id)}"
-}}
-
-variable "environment" {{
-  description = "Environment tag"
-  type        = string
-  default     = "{data['tags'].get('Environment', 'production')}"
-}}
-'''
-        
-        outputs_tf = f'''output "instance_id" {{
-  description = "ID of the EC2 instance"
-  value       = aws_instance.{resource_name}.id
-}}
-
-output "instance_public_ip" {{
-  description = "Public IP address of the instance"
-  value       = aws_instance.{resource_name}.public_ip
-}}
-
-output "instance_private_ip" {{
-  description = "Private IP address of the instance"
-  value       = aws_instance.{resource_name}.private_ip
-}}
-
-output "instance_arn" {{
-  description = "ARN of the EC2 instance"
-  value       = aws_instance.{resource_name}.arn
-}}
-'''
-        
-        return main_tf, variables_tf, outputs_tf
-    
-    def generate_s3_terraform(self, resource_id, data):
-        """Generate Terraform files for S3 bucket"""
+        EC2_MAIN.render(writer.main, {'resource_name': resource_name})
+        EC2_VARIABLES.render(writer.variables, {
+            'ami': hcl(data['ami']),
+            'instance_type': hcl(data['instance_type']),
+            'subnet_id': hcl(data['subnet_id']),
+            'security_group_ids': hcl(data['vpc_security_group_ids']),
+            'key_name': hcl(data['key_name']),
+            'associate_public_ip': hcl(data['associate_public_ip_address']),
+            'root_volume_size': hcl(data['root_block_device']['volume_size']),
+            'root_volume_type': hcl(data['root_block_device']['volume_type']),
+            'instance_name': hcl(data['tags'].get('Name', resource_id)),
+        })
+        EC2_OUTPUTS.render(writer.outputs, {'resource_name': resource_name})
+        writer.environment = data['tags'].get('Environment', 'production')
+    
+    def generate_s3_terraform(self, writer, resource_id, data):
+        """Write the Terraform blocks for an S3 bucket"""
         bucket_name = data['bucket_name'].replace('.', '_').replace('-', '_')
         
-        main_tf = f'''# S3 Bucket Configuration
-resource "aws_s3_bucket" "{bucket_name}" {{
-  bucket = var.bucket_name
-
-  tags = {{
-    Name        = var.bucket_name
-    Environment = var.environment
-    ManagedBy   = "Terraform"
-  }}
-}}
-
-resource "aws_s3_bucket_versioning" "{bucket_name}_versioning" {{
-  bucket = aws_s3_bucket.{bucket_name}.id
-
-  versioning_configuration {{
-    status = var.versioning_enabled ? "Enabled" : "Suspended"
-  }}
-}}
-
-resource "aws_s3_bucket_server_side_encryption_configuration" "{bucket_name}_encryption" {{
-  bucket = aws_s3_bucket.{bucket_name}.id
-
-  rule {{
-    apply_server_side_encryption_by_default {{
-      sse_algorithm = "AES256"
-    }}
-  }}
-}}
-'''
-        
-        variables_tf = f'''variable "region" {{
-  description = "AWS region"
-  type        = string
-  default     = "{self.region}"
-}}
-
-variable "bucket_name" {{
-  description = "Name of the S3 bucket"
-  type        = string
-  default     = "{data['bucket_name']}"
-}}
-
-variable "versioning_enabled" {{
-  description = "Enable bucket versioning"
-  type        = bool
-  default     = {str(data['versioning_enabled']).lower()}
-}}
-
-variable "environment" {{
-  description = "Environment tag"
-  type        = string
-  default     = "production"
-}}
-'''
-        
-        outputs_tf = f'''output "bucket_id" {{
-  description = "Name of the S3 bucket"
-  value       = aws_s3_bucket.{bucket_name}.id
-}}
-
-output "bucket_arn" {{
-  description = "ARN of the S3 bucket"
-  value       = aws_s3_bucket.{bucket_name}.arn
-}}
-
-output "bucket_domain_name" {{
-  description = "Domain name of the bucket"
-  value       = aws_s3_bucket.{bucket_name}.bucket_domain_name
-}}
-'''
-        
-        return main_tf, variables_tf, outputs_tf
-    
-    def generate_security_group_terraform(self, resource_id, data):
-        """Generate Terraform files for Security Group"""
-        sg_name = data['name'].replace(' ', '_').replace('-', '_').lower()
-        
-        ingress_rules = []
+        S3_MAIN.render(writer.main, {'resource_name': bucket_name})
+        write_bucket_rules(writer.main, data, bucket_name, f'{bucket_name}_encryption', f'{bucket_name}_lifecycle')
+        S3_VARIABLES.render(writer.variables, {
+            'bucket_name': hcl(data['bucket_name']),
+            'versioning_enabled': hcl(data['versioning_enabled']),
+        })
+        S3_OUTPUTS.render(writer.outputs, {'resource_name': bucket_name})
+    
+    def ingress_rules(self, data):
+        """INGRESS_RULE values for each CIDR based ingress rule of a security group"""
         for rule in data['ingress']:
-            from_port = rule.get('FromPort', 0)
-            to_port = rule.get('ToPort', 0)
-            protocol = rule.get('IpProtocol', '-1')
             cidr_blocks = [ip_range['CidrIp'] for ip_range in rule.get('IpRanges', [])]
-            
             if cidr_blocks:
-                ingress_rules.append(f'''  ingress {{
-    from_port   = {from_port}
-    to_port     = {to_port}
-    protocol    = "{protocol}"
-    cidr_blocks = {json.dumps(cidr_blocks)}
-  }}''')
-        
-        main_tf = f'''# Security Group Configuration
-resource "aws_security_group" "{sg_name}" {{
-  name        = var.security_group_name
-  description = var.security_group_description
-  vpc_id      = var.vpc_id
-
-{chr(10).join(ingress_rules)}
-
-  egress {{
-    from_port   = 0
-    to_port     = 0
-    protocol    = "-1"
-    cidr_blocks = ["0.0.0.0/0"]
-  }}
-
-  tags = {{
-    Name        = var.security_group_name
-    Environment = var.environment
-    ManagedBy   = "Terraform"
-  }}
-}}
-'''
-        
-        variables_tf = f'''variable "region" {{
-  description = "AWS region"
-  type        = string
-  default     = "{self.region}"
-}}
-
-variable "security_group_name" {{
-  description = "Name of the security group"
-  type        = string
-  default     = "{data['name']}"
-}}
-
-variable "security_group_description" {{
-  description = "Description of the security group"
-  type        = string
-  default     = "{data['description']}"
-}}
-
-variable "vpc_id" {{
-  description = "VPC ID"
-  type        = string
-  default     = "{data['vpc_id']}"
-}}
-
-variable "environment" {{
-  description = "Environment tag"
-  type        = string
-  default     = "production"
-}}
-'''
-        
-        outputs_tf = f'''output "security_group_id" {{
-  description = "ID of the security group"
-  value       = aws_security_group.{sg_name}.id
-}}
-
-output "security_group_arn" {{
-  description = "ARN of the security group"
-  value       = aws_security_group.{sg_name}.arn
-}}
-'''
-        
-        return main_tf, variables_tf, outputs_tf
+                yield {
+                    'from_port': hcl(rule.get('FromPort', 0)),
+                    'to_port': hcl(rule.get('ToPort', 0)),
+                    'protocol': hcl(rule.get('IpProtocol', '-1')),
+                    'cidr_blocks': hcl(cidr_blocks),
+                }
+    
+    def generate_security_group_terraform(self, writer, resource_id, data):
+        """Write the Terraform blocks for a Security Group"""
+        sg_name = data['name'].replace(' ', '_').replace('-', '_').lower()
+        
+        SECURITY_GROUP_MAIN_HEAD.render(writer.main, {'resource_name': sg_name})
+        separator = ''
+        for rule in self.ingress_rules(data):
+            writer.main.write(separator)
+            INGRESS_RULE.render(writer.main, rule)
+            separator = '\n'
+        SECURITY_GROUP_MAIN_TAIL.render(writer.main, {})
+        
+        SECURITY_GROUP_VARIABLES.render(writer.variables, {
+            'name': hcl(data['name']),
+            'description': hcl(data['description']),
+            'vpc_id': hcl(data['vpc_id']),
+        })
+        SECURITY_GROUP_OUTPUTS.render(writer.outputs, {'resource_name': sg_name})
+    
+    def fetch_data(self, resource_type, resource_id, bucket_settings=tuple(BUCKET_CONFIG_CALLS)):
+        """Describe data for a resource render() or render_block() has a template for.
+        Buckets fetch only bucket_settings"""
+        if resource_type == 's3_bucket':
+            return self.get_s3_bucket(resource_id, bucket_settings)
+        get = {
+            'ec2_instance': self.get_ec2_instance,
+            'security_group': self.get_security_group,
+            'vpc': self.get_vpc,
+            'subnet': self.get_subnet,
+        }[resource_type]
+        return self.fetch(resource_type, resource_id, get)
+    
+    def render(self, writer, resource_type, resource_id, data):
+        """Stream a resource's blocks into an open ModuleWriter"""
+        emit = {
+            'ec2_instance': self.generate_ec2_terraform,
+            's3_bucket': self.generate_s3_terraform,
+            'security_group': self.generate_security_group_terraform,
+        }[resource_type]
+        emit(writer, resource_id, data)
+    
+    def write_module(self, output_path, resource_type, resource_id, data):
+        """Write main.tf, variables.tf and outputs.tf for one resource into output_path"""
+        with ModuleWriter(output_path, self.region) as writer:
+            self.render(writer, resource_type, resource_id, data)
+    
+    def fingerprint(self, resource_type, data):
+        """Digest of everything a resource renders from: its normalized describe data, region, templates
+        and rendering code"""
+        payload = [RENDERING_FINGERPRINT, self.region, resource_type, normalize(data)]
+        return hashlib.sha256(json.dumps(payload, default=str).encode()).hexdigest()
+    
+    def export(self, resource_id, output_path, resource_type=None, previous=None):
+        """Identify, fetch, render and write one resource, raising on any failure.
+        Returns (resource_type, fingerprint, written), the module is left alone when the fingerprint
+        matches previous"""
+        if resource_type is None:
+            resource_type, resource_id = self.classify(resource_id)
+        if not resource_type:
+            raise ValueError(f"Could not identify resource type for {resource_id}")
+        
+        if resource_type not in RENDERED_TYPES:
+            raise ValueError(f"Resource type {resource_type} not yet supported")
+        
+        # fetched before any file is opened so a failed describe leaves no partial module behind
+        data = self.fetch_data(resource_type, resource_id, MODULE_BUCKET_SETTINGS)
+        digest = self.fingerprint(resource_type, data)
+        if digest == previous and output_path.exists():
+            return resource_type, digest, False
+        
+        self.write_module(output_path, resource_type, resource_id, data)
+        return resource_type, digest, True
     
     def generate(self, resource_id, output_dir='.'):
         """Main generation function"""
-        resource_type = self.identify_resource_type(resource_id)
+        resource_type, resource_id = self.classify(resource_id)
         
         if not resource_type:
             print(f"Error: Could not identify resource type for {resource_id}")
@@ -407,26 +827,12 @@ output "security_group_arn" {{
         print(f"Fetching resource details...")
         
         try:
-            if resource_type == 'ec2_instance':
-                data = self.get_ec2_instance(resource_id)
-                main_tf, variables_tf, outputs_tf = self.generate_ec2_terraform(resource_id, data)
-            elif resource_type == 's3_bucket':
-                data = self.get_s3_bucket(resource_id)
-                main_tf, variables_tf, outputs_tf = self.generate_s3_terraform(resource_id, data)
-            elif resource_type == 'security_group':
-                data = self.get_security_group(resource_id)
-                main_tf, variables_tf, outputs_tf = self.generate_security_group_terraform(resource_id, data)
-            else:
+            if resource_type not in RENDERED_TYPES:
                 print(f"Error: Resource type {resource_type} not yet supported")
                 return False
             
-            # Write files
-            output_path = Path(output_dir)
-            output_path.mkdir(exist_ok=True)
-            
-            (output_path / 'main.tf').write_text(main_tf)
-            (output_path / 'variables.tf').write_text(variables_tf)
-            (output_path / 'outputs.tf').write_text(outputs_tf)
+            data = self.fetch_data(resource_type, resource_id, MODULE_BUCKET_SETTINGS)
+            self.write_module(Path(output_dir), resource_type, resource_id, data)
             
             print(f"\n✓ Successfully generated Terraform files in {output_dir}/")
             print(f"  - main.tf")
@@ -438,20 +844,425 @@ output "security_group_arn" {{
         except Exception as e:
             print(f"Error: {str(e)}")
             return False
+    
+    def export_all(self, resources, output_dir='.', workers=BULK_WORKERS, complete=False):
+        """Export a stream of (resource_type, resource_id) concurrently, one module directory per resource.
+        At most workers * 4 resources are in flight, so long streams run in bounded memory.
+        Only resources whose fingerprint changed are rewritten. complete means the stream is every resource
+        in the region, so stored resources missing from it were removed and their modules are deleted"""
+        output_path = Path(output_dir)
+        fingerprints = Fingerprints(output_path)
+        current = {}
+        added, changed, failed = [], [], {}
+        skipped = defaultdict(int)
+        unchanged = 0
+        in_flight = {}
+        
+        def collect(futures):
+            nonlocal unchanged
+            for future in futures:
+                resource_type, resource_id = in_flight.pop(future)
+                key = resource_key(resource_type, resource_id)
+                try:
+                    resource_type, current[key], _ = future.result()
+                except Exception as e:
+                    if key in fingerprints.resources:
+                        current[key] = fingerprints.resources[key]
+                    failed[resource_id] = str(e)
+                    print(f"  ✗ {resource_id}: {e}")
+                    continue
+                if current[key] == fingerprints.resources.get(key):
+                    unchanged += 1
+                elif key in fingerprints.resources:
+                    changed.append(resource_id)
+                    print(f"  ~ {resource_id} ({resource_type})")
+                else:
+                    added.append(resource_id)
+                    print(f"  + {resource_id} ({resource_type})")
+        
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for resource_type, resource_id in resources:
+                if resource_type is not None and resource_type not in RENDERED_TYPES:
+                    self.prefetched.pop((resource_type, resource_id), None)
+                    skipped[resource_type] += 1
+                    continue
+                if len(in_flight) >= workers * 4:
+                    collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                previous = None if self.rewrite_all else fingerprints.resources.get(
+                    resource_key(resource_type, resource_id))
+                future = pool.submit(self.export, resource_id, output_path / module_dir_name(resource_id),
+                                     resource_type, previous)
+                in_flight[future] = (resource_type, resource_id)
+            collect(list(in_flight))
+        
+        removed = []
+        if complete:
+            for key in sorted(set(fingerprints.resources) - set(current)):
+                resource_id = key.split('/', 1)[1]
+                shutil.rmtree(output_path / module_dir_name(resource_id), ignore_errors=True)
+                removed.append(resource_id)
+        else:
+            # a partial export says nothing about the resources it wasn't given
+            current = dict(fingerprints.resources, **current)
+        fingerprints.save(current)
+        
+        report_drift(output_dir, added, changed, removed, unchanged)
+        for resource_type, skipped_count in sorted(skipped.items()):
+            print(f"  - skipped {skipped_count} {resource_type} (not yet supported)")
+        if failed:
+            print(f"✗ {len(failed)} failed:")
+            for resource_id, error in failed.items():
+                print(f"  - {resource_id}: {error}")
+        
+        return not failed
+    
+    def generate_bulk(self, resource_ids, output_dir='.', workers=BULK_WORKERS):
+        """Export the given resources, describing EC2 resources in batches first"""
+        print(f"Describing {len(resource_ids)} resources...")
+        resources = self.prefetch(resource_ids)
+        
+        print(f"Exporting {len(resources)} resources with {workers} workers...")
+        return self.export_all(resources, output_dir, workers)
+    
+    def generate_discovered(self, output_dir='.', workers=BULK_WORKERS):
+        """Export every resource discover() finds in the region"""
+        print(f"Discovering resources in {self.region} with {workers} workers...")
+        return self.export_all(self.discover(), output_dir, workers, complete=True)
+    
+    def resource_names(self, exported, modules):
+        """Terraform names for a consolidated export, suffixed with the ID where a name repeats within a type
+        in the same module, so a module's names depend only on its own members"""
+        labels = {}
+        for (resource_type, resource_id), data in exported.items():
+            if resource_type == 'security_group':
+                label = data['name']
+            elif resource_type == 's3_bucket':
+                label = data['bucket_name']
+            else:
+                label = data['tags'].get('Name', resource_id)
+            labels[(resource_type, resource_id)] = terraform_name(label)
+        
+        repeats = Counter((modules[key], key[0], name) for key, name in labels.items())
+        return {
+            key: name if repeats[(modules[key], key[0], name)] == 1 else f'{name}_{terraform_name(key[1])}'
+            for key, name in labels.items()
+        }
+    
+    def module_for(self, resource_type, resource_id, data):
+        """Consolidated module a resource belongs in: its VPC's, or the shared S3 module"""
+        if resource_type == 's3_bucket':
+            return BUCKETS_MODULE
+        vpc_id = resource_id if resource_type == 'vpc' else data['vpc_id']
+        return terraform_name(vpc_id or 'no_vpc')
+    
+    def render_block(self, writer, resource_type, resource_id, data, resource_name, ref):
+        """Write one resource of a consolidated module, ref(resource_type, resource_id) renders a dependency"""
+        values = {'resource_name': resource_name, 'tags': hcl(terraform_tags(data.get('tags', {})))}
+        
+        if resource_type == 'vpc':
+            VPC_BLOCK.render(writer.main, dict(
+                values,
+                cidr_block=hcl(data['cidr_block']),
+                enable_dns_hostnames=hcl(data['enable_dns_hostnames']),
+                enable_dns_support=hcl(data['enable_dns_support']),
+            ))
+        elif resource_type == 'subnet':
+            SUBNET_BLOCK.render(writer.main, dict(
+                values,
+                vpc_id=ref('vpc', data['vpc_id']),
+                cidr_block=hcl(data['cidr_block']),
+                availability_zone=hcl(data['availability_zone']),
+            ))
+        elif resource_type == 'security_group':
+            SECURITY_GROUP_BLOCK_HEAD.render(writer.main, dict(
+                values,
+                name=hcl(data['name']),
+                description=hcl(data['description']),
+                vpc_id=ref('vpc', data['vpc_id']),
+            ))
+            for rule in self.ingress_rules(data):
+                writer.main.write('\n')
+                INGRESS_RULE.render(writer.main, rule)
+                writer.main.write('\n')
+            SECURITY_GROUP_BLOCK_TAIL.render(writer.main, values)
+        elif resource_type == 'ec2_instance':
+            INSTANCE_BLOCK.render(writer.main, dict(
+                values,
+                ami=hcl(data['ami']),
+                instance_type=hcl(data['instance_type']),
+                subnet_id=ref('subnet', data['subnet_id']),
+                security_group_ids='[{}]'.format(', '.join(
+                    ref('security_group', sg_id) for sg_id in data['vpc_security_group_ids'])),
+                key_name=hcl(data['key_name'] or None),
+                associate_public_ip=hcl(data['associate_public_ip_address']),
+                root_volume_size=hcl(data['root_block_device']['volume_size']),
+                root_volume_type=hcl(data['root_block_device']['volume_type']),
+            ))
+        else:
+            BUCKET_BLOCK.render(writer.main, dict(
+                values,
+                bucket_name=hcl(data['bucket_name']),
+                versioning_status=hcl('Enabled' if data['versioning_enabled'] else 'Suspended'),
+            ))
+            write_bucket_rules(writer.main, data, resource_name, resource_name, resource_name)
+            if data['policy']:
+                BUCKET_POLICY_BLOCK.render(writer.main, dict(values, policy=hcl(data['policy'])))
+            if data['logging']:
+                BUCKET_LOGGING_BLOCK.render(writer.main, dict(
+                    values,
+                    target_bucket=ref('s3_bucket', data['logging']['TargetBucket']),
+                    target_prefix=hcl(data['logging'].get('TargetPrefix', '')),
+                ))
+        
+        OUTPUT_ID.render(writer.outputs, {
+            'resource_name': resource_name,
+            'resource_type': TERRAFORM_TYPES[resource_type],
+        })
+    
+    def describe_members(self, pool, keys):
+        """fetch_data for [(resource_type, resource_id)] on pool, EC2 types batched first.
+        Returns ({key: data}, {key: exception})"""
+        self.batch_describe(keys)
+        futures = {pool.submit(self.fetch_data, *key): key for key in keys}
+        found, errors = {}, {}
+        for future in as_completed(futures):
+            try:
+                found[futures[future]] = future.result()
+            except Exception as e:
+                errors[futures[future]] = e
+        return found, errors
+    
+    def generate_consolidated(self, resources, output_dir='.', workers=BULK_WORKERS, complete=False):
+        """Export a stream of (resource_type, resource_id) as one root module for a single state, with a child
+        module per VPC and one for S3 buckets. Resources reference the exported resources they depend on
+        (aws_vpc.x.id, aws_subnet.y.id, aws_security_group.z.id) instead of hardcoding their IDs.
+        A module is always written whole: members placed in it by earlier runs but missing from a partial
+        stream are described again, and dropped only when AWS no longer has them. Only modules with a changed,
+        added or removed member are rewritten, complete is as for export_all"""
+        output_path = Path(output_dir)
+        fingerprints = Fingerprints(output_path)
+        # (resource_type, resource_id) -> module it was written to by earlier runs
+        stored = {tuple(key.split('/', 1)): module for key, module in fingerprints.placement.items()}
+        failed = {}
+        skipped = defaultdict(int)
+        exported = {}
+        errors = {}
+        vanished = set()
+        
+        # references need the whole export, so describe everything before writing anything
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for resource_type, resource_id in resources:
+                if resource_type is None:
+                    failed[resource_id] = f"Could not identify resource type for {resource_id}"
+                elif resource_type not in TERRAFORM_TYPES:
+                    self.prefetched.pop((resource_type, resource_id), None)
+                    skipped[resource_type] += 1
+                else:
+                    futures[pool.submit(self.fetch_data, resource_type, resource_id)] = (resource_type, resource_id)
+            for future in as_completed(futures):
+                try:
+                    exported[futures[future]] = future.result()
+                except Exception as e:
+                    errors[futures[future]] = e
+            modules = {key: self.module_for(*key, data) for key, data in exported.items()}
+            
+            while not complete:
+                touched = set(modules.values()) | {stored[key] for key in [*exported, *errors] if key in stored}
+                members_left_out = [
+                    key for key, module in stored.items()
+                    if module in touched and key not in exported and key not in errors and key not in vanished
+                ]
+                if not members_left_out:
+                    break
+                found, member_errors = self.describe_members(pool, members_left_out)
+                exported.update(found)
+                modules.update((key, self.module_for(*key, data)) for key, data in found.items())
+                for key, error in member_errors.items():
+                    if isinstance(error, LookupError):
+                        vanished.add(key)
+                    else:
+                        errors[key] = error
+        
+        for (resource_type, resource_id), error in errors.items():
+            failed[resource_id] = str(error)
+            print(f"  ✗ {resource_id}: {error}")
+        
+        # a module holding a resource that failed to describe keeps its files and fingerprints as they were
+        held = {stored[key] for key in errors if key in stored}
+        touched = set(modules.values()) | {stored[key] for key in [*exported, *errors, *vanished] if key in stored}
+        
+        names = self.resource_names(exported, modules)
+        type_order = list(TERRAFORM_TYPES)
+        members = defaultdict(list)
+        for key in sorted(exported, key=lambda key: (type_order.index(key[0]), names[key])):
+            if modules[key] not in held:
+                members[modules[key]].append(key)
+        digests = {resource_key(*key): self.fingerprint(key[0], exported[key]) for keys in members.values()
+                   for key in keys}
+        placement = {resource_key(*key): module for module, keys in members.items() for key in keys}
+        # a module's fingerprint covers its members, their names and their fingerprints
+        module_digests = {
+            module: hashlib.sha256(json.dumps(
+                [(resource_key(*key), names[key], digests[resource_key(*key)]) for key in keys]
+            ).encode()).hexdigest()
+            for module, keys in members.items()
+        }
+        for key, module in stored.items():
+            if module in held:
+                placement[resource_key(*key)] = module
+                if resource_key(*key) in fingerprints.resources:
+                    digests[resource_key(*key)] = fingerprints.resources[resource_key(*key)]
+        for module in held:
+            module_digests[module] = fingerprints.modules.get(module, '')
+        
+        if complete:
+            all_digests, all_modules, all_placement = digests, module_digests, placement
+        else:
+            # touched modules were described whole, everything else stays as the earlier runs left it
+            kept = {key for key, module in fingerprints.placement.items() if module not in touched}
+            all_digests = dict({key: fingerprints.resources[key] for key in kept if key in fingerprints.resources},
+                               **digests)
+            all_placement = dict({key: fingerprints.placement[key] for key in kept}, **placement)
+            all_modules = dict({module: digest for module, digest in fingerprints.modules.items()
+                                if module not in touched}, **module_digests)
+        removed_modules = set(fingerprints.modules) - set(all_modules)
+        
+        for module in sorted(members):
+            if not self.rewrite_all and fingerprints.modules.get(module) == module_digests[module]:
+                continue
+            
+            def ref(resource_type, resource_id):
+                key = (resource_type, resource_id)
+                if modules.get(key) == module:
+                    return f'{TERRAFORM_TYPES[resource_type]}.{names[key]}.id'
+                return hcl(resource_id or None)
+            
+            with ModuleWriter(output_path / 'modules' / module, self.region) as writer:
+                MODULE_HEADER.render(writer.main, {'module': module})
+                for resource_type, resource_id in members[module]:
+                    self.render_block(writer, resource_type, resource_id, exported[(resource_type, resource_id)],
+                                      names[(resource_type, resource_id)], ref)
+            print(f"  ✓ {module} ({len(members[module])} resources)")
+        for module in sorted(removed_modules):
+            shutil.rmtree(output_path / 'modules' / module, ignore_errors=True)
+            print(f"  ✓ {module} removed")
+        
+        if self.rewrite_all or set(all_modules) != set(fingerprints.modules) or not (output_path / 'main.tf').exists():
+            with ModuleWriter(output_path, self.region) as root:
+                PROVIDER.render(root.main, {})
+                for module in sorted(all_modules):
+                    MODULE_CALL.render(root.main, {'module': module})
+        fingerprints.save(all_digests, all_modules, all_placement)
+        
+        previous = fingerprints.resources
+        report_drift(
+            output_dir,
+            added=[key for key in digests if key not in previous],
+            changed=[key for key in digests if key in previous and previous[key] != digests[key]],
+            removed=sorted(key.split('/', 1)[1] for key in previous if key not in all_digests),
+            unchanged=sum(1 for key in digests if previous.get(key) == digests[key]),
+        )
+        for resource_type, skipped_count in sorted(skipped.items()):
+            print(f"  - skipped {skipped_count} {resource_type} (not yet supported)")
+        if failed:
+            print(f"✗ {len(failed)} failed:")
+            for resource_id, error in failed.items():
+                print(f"  - {resource_id}: {error}")
+        
+        return not failed
+
+
+# the code that turns describe data into HCL, hashed into every fingerprint with the templates so a rendering
+# fix rewrites the modules it changes without --rewrite-all
+RENDERING_CODE = (
+    terraform_name,
+    terraform_tags,
+    rfc3339,
+    encryption_rule_blocks,
+    lifecycle_filter,
+    lifecycle_rule_blocks,
+    write_bucket_rules,
+    TerraformGenerator.generate_ec2_terraform,
+    TerraformGenerator.generate_s3_terraform,
+    TerraformGenerator.ingress_rules,
+    TerraformGenerator.generate_security_group_terraform,
+    TerraformGenerator.render,
+    TerraformGenerator.resource_names,
+    TerraformGenerator.module_for,
+    TerraformGenerator.render_block,
+    TerraformGenerator.generate_consolidated,
+)
+RENDERING_FINGERPRINT = hashlib.sha256(''.join(
+    [TEMPLATES_FINGERPRINT, repr(TERRAFORM_TYPES), BUCKETS_MODULE]
+    + [inspect.getsource(code) for code in RENDERING_CODE]
+).encode()).hexdigest()
 
 
 def main():
     parser = argparse.ArgumentParser(
         description='Generate Terraform configuration from existing AWS resources'
     )
-    parser.add_argument('resource_id', help='AWS resource ID (e.g., i-1234567890abcdef0)')
+    parser.add_argument('resource_id', nargs='?', help='AWS resource ID (e.g., i-1234567890abcdef0)')
     parser.add_argument('--region', default='us-east-1', help='AWS region (default: us-east-1)')
     parser.add_argument('--output', '-o', default='.', help='Output directory (default: current directory)')
+    parser.add_argument('--ids-file', '-f',
+                        help='Bulk mode: file of resource IDs, one per line, or - for stdin. '
+                             'Each resource is written to its own module directory under --output')
+    parser.add_argument('--discover', action='store_true',
+                        help='Export every EC2 instance, security group and S3 bucket in --region, '
+                             'one module directory per resource under --output')
+    parser.add_argument('--consolidate', action='store_true',
+                        help='With --ids-file or --discover: write one root module for a single state, with a '
+                             'child module per VPC (plus one for S3) whose resources reference each other')
+    parser.add_argument('--workers', type=int, default=BULK_WORKERS,
+                        help=f'Concurrent fetches in bulk and discover modes (default: {BULK_WORKERS})')
+    parser.add_argument('--cache-db', default=str(CACHE_DB), help=f'Describe response cache (default: {CACHE_DB})')
+    parser.add_argument('--cache-ttl', type=int, default=CACHE_TTL,
+                        help=f'Seconds a cached response stays fresh (default: {CACHE_TTL})')
+    parser.add_argument('--no-cache', action='store_true', help='Always query AWS and store nothing')
+    cache_mode = parser.add_mutually_exclusive_group()
+    cache_mode.add_argument('--offline', action='store_true',
+                            help='Render from the describe cache only, ignoring the TTL, without calling AWS. '
+                                 'Entries past the TTL are warned about, only an online run drops deleted resources')
+    cache_mode.add_argument('--refresh', action='store_true', help='Query AWS for everything and re-cache it')
+    parser.add_argument('--rewrite-all', action='store_true',
+                        help='Rewrite every module, not only those whose AWS payload or templates changed')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Write cProfile stats for the run to PATH (read with python -m pstats PATH)')
     
     args = parser.parse_args()
+    if [bool(args.resource_id), bool(args.ids_file), args.discover].count(True) != 1:
+        parser.error('pass one of a resource_id, --ids-file or --discover')
+    if args.no_cache and args.offline:
+        parser.error('--offline needs the describe cache')
+    if args.consolidate and args.resource_id:
+        parser.error('--consolidate applies to --ids-file and --discover')
+    
+    cache = None
+    if not args.no_cache:
+        cache = DescribeCache(args.cache_db, args.cache_ttl, offline=args.offline, refresh=args.refresh)
+    generator = TerraformGenerator(region=args.region, cache=cache, rewrite_all=args.rewrite_all)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    
+    if args.consolidate and args.discover:
+        success = generator.generate_consolidated(generator.discover(), args.output, args.workers, complete=True)
+    elif args.consolidate:
+        resources = generator.prefetch(read_resource_ids(args.ids_file))
+        success = generator.generate_consolidated(resources, args.output, args.workers)
+    elif args.discover:
+        success = generator.generate_discovered(args.output, args.workers)
+    elif args.ids_file:
+        success = generator.generate_bulk(read_resource_ids(args.ids_file), args.output, args.workers)
+    else:
+        success = generator.generate(args.resource_id, args.output)
     
-    generator = TerraformGenerator(region=args.region)
-    success = generator.generate(args.resource_id, args.output)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"Profile written to {args.profile}")
     
     sys.exit(0 if success else 1)
 
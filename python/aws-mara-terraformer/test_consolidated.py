@@ -0,0 +1,93 @@
+"""
+Consolidated exports under moto: partial reruns must keep whole modules, buckets render their own rules
+"""
+
+import json
+import re
+
+import boto3
+import pytest
+
+moto = pytest.importorskip('moto')
+
+from main import FINGERPRINTS_FILE, TerraformGenerator
+
+
+def web(resource_type):
+    return [{'ResourceType': resource_type, 'Tags': [{'Key': 'Name', 'Value': 'web'}]}]
+
+
+@pytest.fixture
+def network():
+    with moto.mock_aws():
+        ec2 = boto3.client('ec2', region_name='us-east-1')
+        vpc_id = ec2.create_vpc(CidrBlock='10.0.0.0/16', TagSpecifications=web('vpc'))['Vpc']['VpcId']
+        subnet_id = ec2.create_subnet(VpcId=vpc_id, CidrBlock='10.0.1.0/24',
+                                      TagSpecifications=web('subnet'))['Subnet']['SubnetId']
+        sg_id = ec2.create_security_group(GroupName='web', Description='web', VpcId=vpc_id)['GroupId']
+        instance_id = ec2.run_instances(ImageId='ami-12c6146b', MinCount=1, MaxCount=1, SubnetId=subnet_id,
+                                        SecurityGroupIds=[sg_id],
+                                        TagSpecifications=web('instance'))['Instances'][0]['InstanceId']
+        yield ec2, {'vpc': vpc_id, 'subnet': subnet_id, 'sg': sg_id, 'instance': instance_id}
+
+
+def export(output_path, resource_ids):
+    generator = TerraformGenerator('us-east-1')
+    resources = generator.prefetch(resource_ids)
+    return generator.generate_consolidated(resources, output_path, workers=4)
+
+
+def module_resources(output_path):
+    (module_path,) = (output_path / 'modules').iterdir()
+    return re.findall(r'^resource "(\w+)" "(\w+)"', (module_path / 'main.tf').read_text(), re.MULTILINE)
+
+
+def test_partial_rerun_keeps_the_whole_module(network, tmp_path):
+    _, ids = network
+    assert export(tmp_path, list(ids.values()))
+    full = module_resources(tmp_path)
+
+    ec2 = boto3.client('ec2', region_name='us-east-1')
+    ec2.create_tags(Resources=[ids['sg']], Tags=[{'Key': 'Team', 'Value': 'edge'}])
+    assert export(tmp_path, [ids['sg']])
+
+    assert module_resources(tmp_path) == full
+    assert ('aws_security_group', 'web') in full and ('aws_instance', 'web') in full
+    assert 'Team' in (next((tmp_path / 'modules').iterdir()) / 'main.tf').read_text()
+    placement = json.loads((tmp_path / FINGERPRINTS_FILE).read_text())['placement']
+    assert {key.split('/', 1)[1] for key in placement} == set(ids.values())
+
+
+def test_partial_rerun_drops_members_gone_from_aws(network, tmp_path):
+    ec2, ids = network
+    extra_sg = ec2.create_security_group(GroupName='extra', Description='extra', VpcId=ids['vpc'])['GroupId']
+    assert export(tmp_path, [*ids.values(), extra_sg])
+    assert ('aws_security_group', 'extra') in module_resources(tmp_path)
+
+    ec2.delete_security_group(GroupId=extra_sg)
+    assert export(tmp_path, [ids['instance']])
+
+    remaining = module_resources(tmp_path)
+    assert ('aws_security_group', 'extra') not in remaining
+    assert len(remaining) == 4
+    placement = json.loads((tmp_path / FINGERPRINTS_FILE).read_text())['placement']
+    assert f'security_group/{extra_sg}' not in placement
+
+
+def test_bucket_renders_its_encryption_and_lifecycle(tmp_path):
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='app-logs')
+        s3.put_bucket_encryption(Bucket='app-logs', ServerSideEncryptionConfiguration={'Rules': [{
+            'ApplyServerSideEncryptionByDefault': {'SSEAlgorithm': 'aws:kms', 'KMSMasterKeyID': 'alias/logs'},
+        }]})
+        s3.put_bucket_lifecycle_configuration(Bucket='app-logs', LifecycleConfiguration={'Rules': [
+            {'ID': 'tmp', 'Status': 'Enabled', 'Filter': {'Prefix': 'tmp/'}, 'Expiration': {'Days': 30}},
+        ]})
+        assert export(tmp_path, ['app-logs'])
+    
+    main_tf = (tmp_path / 'modules' / 's3' / 'main.tf').read_text()
+    assert 'sse_algorithm = "aws:kms"' in main_tf and 'kms_master_key_id = "alias/logs"' in main_tf
+    assert 'AES256' not in main_tf
+    assert ('aws_s3_bucket_lifecycle_configuration', 'app_logs') in module_resources(tmp_path)
+    assert 'prefix = "tmp/"' in main_tf and 'days = 30' in main_tf